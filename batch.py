@@ -0,0 +1,274 @@
+# Copyright 2022 Dörte de Kok
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs the splits listed in a manifest in one process, sharing one pool of worker processes, e.g.:
+#   python3 batch.py manifest.json --jobs 0
+# Every job gives the same output files as the matching model.py command.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+
+import pandas as pd
+from threadpoolctl import threadpool_limits
+
+import model
+
+
+class Job(NamedTuple):
+    # input file and one column type per column of it, as for model.py
+    file: str
+    sets: int
+    columns: list
+    runs: int = 1
+    seed: int = None
+    attempts: int = 20
+    optimize: int = 0
+    sample_size: int = None
+    k_select: object = 'silhouette'
+    assign: str = 'balanced'
+    min_cluster_rows: int = 10
+    combine: str = None
+    # name the output files start with (default: the name of the input file without its extension)
+    output: str = None
+
+
+# how to read every field of a job from a manifest, where all values may be text (CSV)
+FIELD_TYPES = {'sets': int, 'runs': int, 'seed': int, 'attempts': int, 'optimize': int, 'sample_size': int,
+               'k_select': model.k_selection, 'min_cluster_rows': int}
+
+
+def read_manifest(path):
+    # A list of jobs, from a JSON file (a list of objects, or an object with a "jobs" list), a YAML file
+    # (the same, needs PyYAML) or a CSV file (one job per row, column types separated by spaces).
+    # Input files are relative to the manifest.
+    suffix = pathlib.Path(path).suffix.lower()
+    if suffix == '.csv':
+        entries = pd.read_csv(path, dtype=str, keep_default_na=False).to_dict('records')
+        entries = [{field: value for field, value in entry.items() if value != ''} for entry in entries]
+    else:
+        with open(path) as f:
+            if suffix in ('.yaml', '.yml'):
+                import yaml
+                entries = yaml.safe_load(f)
+            else:
+                entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries.get('jobs', [])
+
+    jobs = []
+    for number, entry in enumerate(entries, 1):
+        unknown = set(entry) - set(Job._fields)
+        if unknown:
+            raise ValueError("Job %s: unknown field(s) %s" % (number, ", ".join(sorted(unknown))))
+        missing = {'file', 'sets', 'columns'} - set(entry)
+        if missing:
+            raise ValueError("Job %s: missing field(s) %s" % (number, ", ".join(sorted(missing))))
+        entry = dict(entry)
+        for field, field_type in FIELD_TYPES.items():
+            if field in entry and entry[field] is not None:
+                try:
+                    entry[field] = field_type(str(entry[field]))
+                except (ValueError, argparse.ArgumentTypeError) as e:
+                    raise ValueError("Job %s: %s: %s" % (number, field, e))
+        if isinstance(entry['columns'], str):
+            entry['columns'] = entry['columns'].split()
+        # the choices of the matching model.py options
+        if entry.get('combine') not in (None, 'csv', 'parquet'):
+            raise ValueError("Job %s: combine must be csv or parquet, not '%s'" % (number, entry['combine']))
+        if entry.get('assign', 'balanced') not in model.ASSIGNMENTS:
+            raise ValueError("Job %s: assign must be one of %s, not '%s'"
+                             % (number, ", ".join(model.ASSIGNMENTS), entry['assign']))
+        entry['file'] = str(pathlib.Path(path).parent / entry['file'])
+        jobs.append(Job(**entry))
+
+    names = [output_name(job) for job in jobs]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise ValueError("Several jobs write '%s' output files; give them an 'output' name" % name)
+    return jobs
+
+
+def output_name(job):
+    return job.output or pathlib.Path(job.file).with_suffix('').name
+
+
+def read_data(path):
+    # the whole input file; every file is only read once, however many jobs use it
+    if pathlib.Path(path).suffix.lower() in model.COLUMNAR_SUFFIXES:
+        return model.read_columnar(path)
+    return pd.read_csv(path)
+
+
+def make_splitter(job, data):
+    if len(job.columns) != len(data.columns):
+        raise ValueError("%s column types were given for the %s columns of %s"
+                         % (len(job.columns), len(data.columns), job.file))
+    model.check_column_types(job.columns)
+    # as in model.py, labels and disregarded columns are copied from the file when the output is written
+    types = {column: feature for column, feature in zip(data.columns, job.columns) if feature not in ('l', 'd')}
+    inputD = model.compact_dtypes(data[list(types)].copy(), types)
+    return model.Splitter(inputD, list(types.values()), job.sets, job.attempts, swaps=job.optimize,
+                          sample_size=job.sample_size, k_select=job.k_select, assignment=job.assign,
+                          min_cluster_rows=job.min_cluster_rows)
+
+
+# set once per worker process: the splitter of every job
+_worker_splitters = {}
+
+
+def _init_worker(splitters, sweeps, profile=None):
+    _worker_splitters.update(splitters)
+    model.sweep_cache.update(sweeps)
+    model.set_profile_path(profile)
+    threadpool_limits(1)
+
+
+def timed_run(splitter, seed, reuse_sweep=False):
+    start = time.perf_counter()
+    result = splitter.run(seed, reuse_sweep=reuse_sweep)
+    return result, time.perf_counter() - start
+
+
+def _run(number, seed, reuse_sweep=False):
+    return timed_run(_worker_splitters[number], seed, reuse_sweep)
+
+
+class JobStatus:
+    # what happened to one job so far, for the summary
+
+    def __init__(self, job):
+        self.job = job
+        self.finished = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.error = None
+
+    def row(self):
+        if self.error is not None:
+            status = "error: %s" % self.error
+        elif self.failed > 0:
+            status = "%s of %s runs found no split with p >= .2" % (self.failed, self.job.runs)
+        else:
+            status = "ok"
+        return {'file': self.job.file, 'sets': self.job.sets, 'runs': self.finished, 'output': output_name(self.job),
+                'seconds': round(self.seconds, 2), 'status': status}
+
+
+def run_batch(jobs, workers=1):
+    # Run every job; a job that fails does not stop the others. Returns the status of every job.
+    statuses = [JobStatus(job) for job in jobs]
+    data = {}
+    splitters = {}
+    for number, job in enumerate(jobs):
+        try:
+            if job.file not in data:
+                data[job.file] = read_data(job.file)
+            splitters[number] = make_splitter(job, data[job.file])
+        except Exception as e:
+            statuses[number].error = e
+            report(statuses[number])
+    # only the splitters are needed from here on
+    data.clear()
+
+    writers = {number: model.OutputWriter(splitter, output_name(jobs[number]), jobs[number].file,
+                                          jobs[number].combine)
+               for number, splitter in splitters.items()}
+    tasks = [(number, it_num, seed) for number in splitters
+             for it_num, seed in enumerate(model.run_seeds(jobs[number].seed, jobs[number].runs))]
+
+    def finished(number, it_num, outcome):
+        status = statuses[number]
+        if isinstance(outcome, Exception):
+            status.error = status.error or outcome
+        else:
+            result, seconds = outcome
+            writers[number].add(it_num, result)
+            status.failed += result.significant
+            status.seconds += seconds
+        status.finished += 1
+        if status.finished == jobs[number].runs:
+            try:
+                writers[number].close()
+            except Exception as e:
+                status.error = status.error or e
+            report(status)
+
+    if workers == 1:
+        for number, it_num, seed in tasks:
+            try:
+                outcome = timed_run(splitters[number], seed, it_num == 0)
+            except Exception as e:
+                outcome = e
+            finished(number, it_num, outcome)
+    else:
+        for splitter in splitters.values():
+            splitter.prepare_sweeps(workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(splitters, model.sweep_cache, model.profile_path)) as pool:
+            futures = {pool.submit(_run, number, seed, it_num == 0): (number, it_num, seed)
+                       for number, it_num, seed in tasks}
+            for future in as_completed(futures):
+                number, it_num, seed = futures[future]
+                finished(number, it_num, future.exception() or future.result())
+    return statuses
+
+
+def report(status):
+    row = status.row()
+    print("%s (%s sets): %s" % (row['output'], row['sets'], row['status']))
+    sys.stdout.flush()
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='run all splits listed in a manifest in one process')
+    parser.add_argument('manifest', type=pathlib.Path,
+                        help='JSON, YAML or CSV file with one job per entry: file, sets and columns, and '
+                             'optionally runs, seed, attempts, optimize, sample_size, k_select, assign, '
+                             'min_cluster_rows, combine and output')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of runs to compute at the same time, over all jobs (0 uses all cores)')
+    parser.add_argument('--summary', help='also write the status of every job to this csv file')
+    parser.add_argument('--profile', metavar='FILE', default=None, help='as in model.py')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    model.set_profile_path(args.profile)
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError, ImportError) as e:
+        print("Could not read the manifest: %s" % e)
+        sys.exit(1)  # abort
+
+    workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    statuses = run_batch(jobs, workers)
+
+    summary = pd.DataFrame([status.row() for status in statuses])
+    print()
+    print(summary.to_string(index=False))
+    if args.summary:
+        summary.to_csv(args.summary, index=False)
+    if any(status.error is not None for status in statuses):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
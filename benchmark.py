@@ -0,0 +1,244 @@
+# Copyright 2022 Dörte de Kok
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Times every phase of a split on synthetic item pools of different shapes and compares the timings
+# with an earlier baseline, e.g.:
+#   python3 benchmark.py --save baseline.json
+#   python3 benchmark.py --compare baseline.json
+# Larger pools are best timed with --sample-size, e.g. --rows 100000 --sample-size 2000.
+# With --attempt-runs, it also compares how many attempts the set assignments need to find a split with
+# p >= .2, e.g.:
+#   python3 benchmark.py --attempt-runs 20
+
+from itertools import product
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import model
+
+PHASES = ('prepare', 'sweep', 'assignment', 'statistics', 'output')
+PARAMETERS = ('rows', 'numeric', 'categorical', 'cardinality', 'sets', 'strata')
+# options that change the timings of every case; a baseline is only compared with runs that use the same
+SETTINGS = ('sample_size', 'k_select', 'assign')
+# the timed() phases of an attempt that make up each benchmark phase
+ATTEMPT_PHASES = {'assignment': ('fit', 'divide_in_sets'), 'statistics': ('statistics',)}
+
+
+def make_pool(rows, numeric, categorical, cardinality, strata, seed=0):
+    # A synthetic item pool: a label, an absolute column with 'strata' instances (none if strata < 2),
+    # skewed numerical columns and categorical columns with 'cardinality' categories of uneven frequency.
+    # Returns the data and its column types.
+    rng = np.random.default_rng(seed)
+    data = {'item': ['item%d' % i for i in range(rows)]}
+    columns = ['l']
+    if strata > 1:
+        data['stratum'] = rng.integers(0, strata, rows)
+        columns.append('a')
+    for i in range(numeric):
+        data['num%d' % i] = np.round(rng.lognormal(0, 1, rows), 2)
+        columns.append('n')
+    weights = 1 / np.arange(1, cardinality + 1)
+    for i in range(categorical):
+        data['cat%d' % i] = rng.choice(cardinality, rows, p=weights / weights.sum())
+        columns.append('c')
+    return pd.DataFrame(data), columns
+
+
+def time_phase(timings, phase, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+    return result
+
+
+def run_attempt(timings, splitter, seed):
+    # One attempt of the real code (Splitter.run_all), timed by its own timed() phases: fitting the clusters
+    # of every stratum (the sweep is already done) and dividing them in sets count as assignment, then the
+    # statistics. Returns the result of the attempt.
+    previous = model.profile_path
+    with tempfile.TemporaryDirectory() as directory:
+        events = os.path.join(directory, 'events.jsonl')
+        model.set_profile_path(events)
+        try:
+            set_numbers, stats, all_ns = splitter.run_all(seed)
+        finally:
+            model.set_profile_path(previous)
+        with open(events) as f:
+            phases = [json.loads(line) for line in f]
+    for phase, parts in ATTEMPT_PHASES.items():
+        timings[phase] = sum(event['wall'] for event in phases
+                             if event['event'] == 'phase' and event['phase'] in parts)
+    return model.SplitResult(set_numbers, stats, 0, not all_ns)
+
+
+def run_case(case, sample_size=None, seed=0, k_select='silhouette', assignment='balanced'):
+    # time every phase of one split of a generated pool
+    data, columns = make_pool(case['rows'], case['numeric'], case['categorical'], case['cardinality'],
+                              case['strata'], seed)
+    # every case starts without sweeps from earlier cases
+    model.sweep_cache.clear()
+    timings = {}
+    splitter = time_phase(timings, 'prepare', model.Splitter, data, columns, case['sets'],
+                          sample_size=sample_size, k_select=k_select, assignment=assignment)
+    time_phase(timings, 'sweep', splitter.prepare_sweeps)
+    result = run_attempt(timings, splitter, seed)
+    with tempfile.TemporaryDirectory() as directory:
+        time_phase(timings, 'output', model.write_out, splitter, result, os.path.join(directory, 'bench'), 0)
+    return timings
+
+
+def attempts_case(case, runs, sample_size=None, seed=0, k_select='silhouette'):
+    # For every assignment: the share of 'runs' runs that pass at the first attempt, the mean number of
+    # attempts of the runs that pass and the number of runs that do not pass within 20 attempts. All
+    # assignments get the same clusters.
+    data, columns = make_pool(case['rows'], case['numeric'], case['categorical'], case['cardinality'],
+                              case['strata'], seed)
+    model.sweep_cache.clear()
+    outcome = {}
+    for assignment in model.ASSIGNMENTS:
+        splitter = model.Splitter(data, columns, case['sets'], sample_size=sample_size, k_select=k_select,
+                                  assignment=assignment)
+        results = [splitter.run(run_seed) for run_seed in model.run_seeds(seed, runs)]
+        attempts = [result.iteration + 1 for result in results if not result.significant]
+        outcome[assignment + '_first'] = attempts.count(1) / runs
+        outcome[assignment + '_attempts'] = np.mean(attempts) if attempts else np.nan
+        outcome[assignment + '_failed'] = runs - len(attempts)
+    return outcome
+
+
+def case_key(case):
+    return tuple(case[parameter] for parameter in PARAMETERS)
+
+
+def settings_of(case):
+    # the SETTINGS of a case as text, the same whether it was read from JSON or CSV (None if not saved)
+    return tuple('None' if pd.isna(case.get(setting)) else str(case[setting]) for setting in SETTINGS)
+
+
+def check_settings(baseline, settings):
+    # every case of a baseline timed with other settings would be compared with something else
+    for case in baseline:
+        if settings_of(case) != settings_of(settings):
+            raise ValueError("The baseline was timed with %s, not with %s; save a new baseline with these settings"
+                             % tuple(', '.join('%s=%s' % item for item in zip(SETTINGS, settings_of(values)))
+                                     for values in (case, settings)))
+
+
+def compare(results, baseline, tolerance, minimum=0.05):
+    # Phases that got more than 'tolerance' times slower than in the baseline. Phases that take less
+    # than 'minimum' seconds in both are too noisy to compare.
+    old = {case_key(case): case for case in baseline}
+    regressions = []
+    for case in results:
+        if case_key(case) not in old:
+            continue
+        for phase in PHASES:
+            before, after = old[case_key(case)][phase], case[phase]
+            if max(before, after) >= minimum and after > before * tolerance:
+                regressions.append((case, phase, before, after))
+    return regressions
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='time the phases of a split on synthetic item pools; '
+                                                 'every combination of the given values is one case')
+    parser.add_argument('--rows', type=int, nargs='+', default=[250, 1000], help='items per pool')
+    parser.add_argument('--numeric', type=int, nargs='+', default=[2], help='numerical columns')
+    # mixed numerical and categorical data is much slower to cluster than numerical data alone
+    parser.add_argument('--categorical', type=int, nargs='+', default=[0, 2], help='categorical columns')
+    parser.add_argument('--cardinality', type=int, nargs='+', default=[5],
+                        help='categories per categorical column')
+    parser.add_argument('--sets', type=int, nargs='+', default=[3], help='number of sets')
+    parser.add_argument('--strata', type=int, nargs='+', default=[2],
+                        help='instances of the absolute variable (1 for no absolute variable)')
+    parser.add_argument('--sample-size', type=int, default=None, help='large-data mode, as in model.py')
+    parser.add_argument('--k-select', type=model.k_selection, default='silhouette',
+                        help='how to choose the number of clusters, as in model.py')
+    parser.add_argument('--assign', choices=model.ASSIGNMENTS, default='balanced',
+                        help='how to divide the clusters in sets, as in model.py')
+    parser.add_argument('--attempt-runs', type=int, default=0,
+                        help='also split every pool this many times with every assignment and report the share '
+                             'of runs that pass at the first attempt and the mean number of attempts')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='time every case this many times and keep the fastest time per phase')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated pools and the split')
+    parser.add_argument('--save', help='write the timings to this file (.json or .csv)')
+    parser.add_argument('--compare', help='baseline file (.json or .csv) to compare the timings with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='report a phase as a regression if it is this many times slower than the baseline')
+    return parser.parse_args(argv)
+
+
+def save(results, file_name):
+    if file_name.endswith('.csv'):
+        pd.DataFrame(results).to_csv(file_name, index=False)
+    else:
+        with open(file_name, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+def load(file_name):
+    if file_name.endswith('.csv'):
+        return pd.read_csv(file_name).to_dict('records')
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    baseline = load(args.compare) if args.compare else []
+    settings = {'sample_size': args.sample_size, 'k_select': args.k_select, 'assign': args.assign}
+    try:
+        check_settings(baseline, settings)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    results = []
+    for values in product(args.rows, args.numeric, args.categorical, args.cardinality, args.sets, args.strata):
+        case = dict(zip(PARAMETERS, values))
+        runs = [run_case(case, args.sample_size, args.seed, args.k_select, args.assign) for _ in range(args.repeat)]
+        case.update({phase: min(timings[phase] for timings in runs) for phase in PHASES})
+        case.update(settings)
+        results.append(case)
+        print(' '.join('%s=%s' % (parameter, case[parameter]) for parameter in PARAMETERS) + ': '
+              + ', '.join('%s %.3fs' % (phase, case[phase]) for phase in PHASES))
+        if args.attempt_runs > 0:
+            case.update(attempts_case(case, args.attempt_runs, args.sample_size, args.seed, args.k_select))
+            for assignment in model.ASSIGNMENTS:
+                print('    %s assignment: %.0f%% pass at the first attempt, %.2f attempts on average, %s of %s '
+                      'runs fail' % (assignment, 100 * case[assignment + '_first'], case[assignment + '_attempts'],
+                                     case[assignment + '_failed'], args.attempt_runs))
+        sys.stdout.flush()
+
+    if args.save:
+        save(results, args.save)
+    if args.compare:
+        regressions = compare(results, baseline, args.tolerance)
+        for case, phase, before, after in regressions:
+            print("Regression in %s for %s: %.3fs -> %.3fs"
+                  % (phase, ', '.join('%s=%s' % (p, case[p]) for p in PARAMETERS), before, after))
+        if regressions:
+            sys.exit(1)
+        print("No regressions compared to %s" % args.compare)
+
+
+if __name__ == '__main__':
+    main()
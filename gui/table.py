@@ -1,11 +1,19 @@
+import os
 import sys
+import numpy as np
 import pandas as pd
-from PyQt5 import QtCore, QtGui, QtWidgets 
+from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QLabel, QComboBox
 
 from interface.MainWindow import Ui_MainWindow
 
+# the splitting code (model.py) is in the folder above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# data type (as in model.py) of every choice in the top row of the table
+CHOICES = {'ignore': 'd', 'label': 'l', 'categorical': 'c', 'continuous': 'n', 'absolute': 'a'}
+
 
 class Delegate(QtWidgets.QItemDelegate):
 	def __init__(self, owner, choices):
@@ -16,6 +24,9 @@ class Delegate(QtWidgets.QItemDelegate):
 		self.editor.addItems(self.items)
 		return self.editor
 	def paint(self, painter, option, index):
+		# the columns with the results of a split have no choice
+		if not index.flags() & QtCore.Qt.ItemIsEditable:
+			return QtWidgets.QItemDelegate.paint(self, painter, option, index)
 		value = index.data(QtCore.Qt.DisplayRole)
 		style = QtWidgets.QApplication.style()
 		opt = QtWidgets.QStyleOptionComboBox()
@@ -29,132 +40,350 @@ class Delegate(QtWidgets.QItemDelegate):
 		editor.setCurrentIndex(num)
 	def setModelData(self, editor, model, index):
 		value = editor.currentText()
-		model.setData(index, QtCore.Qt.DisplayRole, QtCore.QVariant(value))
+		model.setData(index, value, QtCore.Qt.EditRole)
 	def updateEditorGeometry(self, editor, option, index):
 		editor.setGeometry(option.rect)
 
 
-class TableModel(QtCore.QAbstractTableModel): 
-	def __init__(self, data):
+class TableModel(QtCore.QAbstractTableModel):
+	'''
+	The top row holds the choice for every column, the rows below it the data.
+	Every column is kept as an array of the texts shown, so painting a cell
+	is a lookup. Rows are added to the view FETCH at a time, as it scrolls
+	down to them, so large files do not slow the view down.
+	'''
+
+	FETCH = 500
+
+	def __init__(self, columns=(), choice='ignore'):
 		super().__init__()
-		self._data = data
-		
-	def data(self, index, role): 
-		if role == Qt.DisplayRole:
-		# See below for the nested-list data structure. # .row() indexes into the outer list,
-		# .column() indexes into the sub-list
-			value = self._data.iloc[index.row(), index.column()]
-			return str(value)
+		self.headers = [str(column) for column in columns]
+		self.choices = [choice] * len(self.headers)
+		self.columns = [np.empty(0, dtype=object) for column in self.headers]
+		# the columns of the file; the set numbers of every run of a split follow them
+		self.fileColumns = len(self.headers)
+		# number of data rows in the view
+		self.shown = 0
+
+	def rowsRead(self):
+		return len(self.columns[0]) if self.columns else 0
+
+	def appendRows(self, chunk):
+		# the next rows of the file (a DataFrame), converted to text once
+		for i, column in enumerate(chunk.columns):
+			self.columns[i] = np.concatenate([self.columns[i], chunk[column].astype(str).to_numpy(dtype=object)])
+		# the view asks for more rows when it is scrolled down, but not while it is still (almost) empty
+		if self.shown < self.FETCH:
+			self.fetchMore(QtCore.QModelIndex())
+
+	def addSets(self, header, set_numbers):
+		column = len(self.columns)
+		self.beginInsertColumns(QtCore.QModelIndex(), column, column)
+		self.headers.append(header)
+		self.choices.append('')
+		self.columns.append(np.asarray(set_numbers).astype(str).astype(object))
+		self.endInsertColumns()
+
+	def removeSets(self):
+		if len(self.columns) > self.fileColumns:
+			self.beginRemoveColumns(QtCore.QModelIndex(), self.fileColumns, len(self.columns) - 1)
+			del self.headers[self.fileColumns:], self.choices[self.fileColumns:], self.columns[self.fileColumns:]
+			self.endRemoveColumns()
+
+	def data(self, index, role):
+		if role == Qt.DisplayRole or role == Qt.EditRole:
+			# row 0 holds the choices, data row i is in row i + 1
+			if index.row() == 0:
+				return self.choices[index.column()]
+			return self.columns[index.column()][index.row() - 1]
 
 	def setData(self, index, value, role):
-		if role == QtCore.Qt.EditRole:
-			self._data.iloc[index.row(), index.column()] = value
-		return True
+		# only the choices can be changed
+		if role == QtCore.Qt.EditRole and index.row() == 0:
+			self.choices[index.column()] = value
+			self.dataChanged.emit(index, index)
+			return True
+		return False
+
+	def rowCount(self, index=QtCore.QModelIndex()):
+		if index.isValid() or not self.headers:
+			return 0
+		return self.shown + 1
+
+	def columnCount(self, index=QtCore.QModelIndex()):
+		if index.isValid():
+			return 0
+		return len(self.headers)
 
-	def rowCount(self, index):
-		# The length of the outer list.
-		return self._data.shape[0]
+	def canFetchMore(self, index):
+		return not index.isValid() and self.shown < self.rowsRead()
 
-	def columnCount(self, index):
-		# The following takes the first sub-list, and returns
-		# the length (only works if all rows are an equal length) 
-		return self._data.shape[1]
+	def fetchMore(self, index):
+		count = min(self.FETCH, self.rowsRead() - self.shown)
+		if index.isValid() or count <= 0:
+			return
+		self.beginInsertRows(QtCore.QModelIndex(), self.shown + 1, self.shown + count)
+		self.shown += count
+		self.endInsertRows()
 
 	def flags(self, index):
-		return QtCore.Qt.ItemIsEditable | QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+		if index.row() == 0 and index.column() < self.fileColumns:
+			return QtCore.Qt.ItemIsEditable | QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+		return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
 
 	def headerData(self, section, orientation, role):
 		if role == Qt.DisplayRole:
 			if orientation == Qt.Horizontal:
-				return str(self._data.columns[section])
+				return self.headers[section]
 			#if orientation == Qt.Vertical:
 			#	return str(self._data.index[section])
 
 
-	def isValid( self, fileName ):
-		try: 
-			file = open( fileName, 'r' )
-			file.close()
-			return True
-		except:
-			return False
-
-	def readFile( self, fileName ):
-		'''
-		sets the member fileName to the value of the argument
-		if the file exists.  Otherwise resets both the filename
-		and file contents members.
-		'''
-
-		if self.isValid( fileName ):
-			if fileName.endswith('.csv'):
-				self.fileContents = pd.read_csv(fileName)
-			else:
-				self.fileContents = pd.read_excel(fileName)
-
-		else:
-			self.fileContents = ""
-
-class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow): 
+class FileLoader(QtCore.QThread):
+	'''
+	Reads a spreadsheet in the background. csv files are read in chunks, so
+	the first rows are shown while the rest is still being read; every chunk
+	is sent with chunkRead and the whole file with loaded. Cancelling (with
+	requestInterruption) stops after the current chunk.
+	'''
+
+	chunkRead = QtCore.pyqtSignal(object)
+	progress = QtCore.pyqtSignal(int)
+	loaded = QtCore.pyqtSignal(object)
+	failed = QtCore.pyqtSignal(str)
+
+	CHUNK = 20000
+
+	def __init__(self, fileName):
+		super().__init__()
+		self.fileName = fileName
+
+	def run(self):
+		try:
+			chunks = []
+			for chunk in self.read():
+				if self.isInterruptionRequested():
+					return
+				chunks.append(chunk)
+				self.chunkRead.emit(chunk)
+			self.loaded.emit(pd.concat(chunks, ignore_index=True))
+		except Exception as e:
+			self.failed.emit(str(e))
+
+	def read(self):
+		if not self.fileName.endswith('.csv'):
+			# excel files can only be read as a whole
+			data = pd.read_excel(self.fileName)
+			self.progress.emit(100)
+			yield data
+			return
+		size = max(os.path.getsize(self.fileName), 1)
+		with open(self.fileName, 'rb') as f:
+			for chunk in pd.read_csv(f, chunksize=self.CHUNK):
+				# percentage of the file read so far
+				self.progress.emit(min(100 * f.tell() // size, 100))
+				yield chunk
+
+
+class SplitWorker(QtCore.QThread):
+	'''
+	Splits the data in the background, one run after another. Every run is
+	sent with runFinished as soon as it is done: its number, the set number
+	of every row and whether no split with p >= .2 was found. Cancelling
+	stops after the current run.
+	'''
+
+	runFinished = QtCore.pyqtSignal(int, object, bool)
+	progress = QtCore.pyqtSignal(int)
+	failed = QtCore.pyqtSignal(str)
+
+	def __init__(self, fileName, data, columns, sets, runs):
+		super().__init__()
+		self.fileName = fileName
+		self.data = data
+		self.columns = columns
+		self.sets = sets
+		self.runs = runs
+
+	def run(self):
+		try:
+			# loading the splitting code (and scikit-learn) takes a while, so it is done here as well
+			import batch
+			import model
+			splitter = batch.make_splitter(batch.Job(self.fileName, self.sets, self.columns), self.data)
+			for it_num, seed in enumerate(model.run_seeds(None, self.runs)):
+				if self.isInterruptionRequested():
+					return
+				result = splitter.run(seed, reuse_sweep=it_num == 0)
+				self.runFinished.emit(it_num, result.set_numbers.to_numpy(), bool(result.significant))
+				self.progress.emit(it_num + 1)
+		except Exception as e:
+			self.failed.emit(str(e))
+
+
+class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 	def __init__(self):
 		super().__init__()
 		self.setupUi(self)
 
-		data = pd.DataFrame()
-		self.model = TableModel(data)
+		self.model = TableModel()
 		self.label.hide()
 		self.tableView.hide()
 
 		self.pushButton.clicked.connect(self.browse)
 		self.label_2.hide()
 
-	def refreshAll(self, data, variables):
-		choices = ['ignore', 'categorical', 'continuous']
-		
+		self.fileName = None
+		# the whole file, once it is read
+		self.data = None
+		# the current FileLoader and SplitWorker, and all threads that still run (also replaced ones)
+		self.loader = None
+		self.worker = None
+		self.threads = []
+		self.addSplitControls()
+
+	def addSplitControls(self):
+		# number of sets and runs and the buttons to split and cancel above the table, progress below it
+		toolbar = self.addToolBar('Split')
+		toolbar.addWidget(QLabel('Sets '))
+		self.setsBox = QtWidgets.QSpinBox()
+		self.setsBox.setRange(2, 100)
+		toolbar.addWidget(self.setsBox)
+		toolbar.addWidget(QLabel(' Runs '))
+		self.runsBox = QtWidgets.QSpinBox()
+		self.runsBox.setRange(1, 1000)
+		toolbar.addWidget(self.runsBox)
+		self.splitButton = QtWidgets.QPushButton('Split')
+		self.splitButton.setEnabled(False)
+		self.splitButton.clicked.connect(self.split)
+		toolbar.addWidget(self.splitButton)
+		self.cancelButton = QtWidgets.QPushButton('Cancel')
+		self.cancelButton.setEnabled(False)
+		self.cancelButton.clicked.connect(self.cancel)
+		toolbar.addWidget(self.cancelButton)
+		self.progressBar = QtWidgets.QProgressBar()
+		self.progressBar.hide()
+		self.statusBar().addPermanentWidget(self.progressBar)
+
+	def refreshAll(self, columns):
+		choices = list(CHOICES)
+
 		#show table view
 		self.label.show()
 		self.tableView.show()
 
-		#display top 5 (.head()) rows of data file
-		self.model= TableModel(data.head())
+		#rows are added as they are read
+		self.model = TableModel(columns)
 		self.tableView.setModel(self.model)
 		#add combo boxes
 		self.tableView.setItemDelegateForRow(0,Delegate(self,choices))
 		# make combo boxes editable with a single-click:
-		for column in range( self.model._data.shape[1] ):
+		for column in range( self.model.fileColumns ):
 			self.tableView.openPersistentEditor(self.model.index(0, column))
 
 
 		self.label_2.show()
 
 	def browse(self):
-		#choices = ['ignore', 'categorical', 'continuous']
 		fileName, _ = QtWidgets.QFileDialog.getOpenFileName(
 						None,
 						"Choose File", "",
 						"Spreadsheet (*.xlsx *.xls *.csv)")
 		if fileName:
-			self.model.readFile(fileName)
-			data = self.model.fileContents
-			
+			self.cancel()
+			self.fileName = fileName
+			self.data = None
+			self.model = None
+			self.loader = FileLoader(fileName)
+			self.loader.chunkRead.connect(self.showRows)
+			self.loader.progress.connect(self.showProgress)
+			self.loader.loaded.connect(self.loaded)
+			self.loader.failed.connect(self.showError)
+			self.start(self.loader, 100, "Reading %s" % os.path.basename(fileName))
+
+	def showRows(self, chunk):
+		# signals of a loader that was cancelled may still come in
+		if self.sender() is not self.loader:
+			return
+		if self.model is None:
+			self.refreshAll(chunk.columns)
+		self.model.appendRows(chunk)
+
+	def loaded(self, data):
+		if self.sender() is not self.loader:
+			return
+		if self.model is None:
+			self.refreshAll(data.columns)
+		self.data = data
+		self.statusBar().showMessage("%s rows" % len(data))
+
+	def split(self):
+		self.cancel()
+		self.model.removeSets()
+		columns = [CHOICES[choice] for choice in self.model.choices[:self.model.fileColumns]]
+		self.worker = SplitWorker(self.fileName, self.data, columns, self.setsBox.value(), self.runsBox.value())
+		self.worker.runFinished.connect(self.showRun)
+		self.worker.progress.connect(self.showProgress)
+		self.worker.failed.connect(self.showError)
+		self.start(self.worker, self.runsBox.value(), "Splitting")
+
+	def showRun(self, it_num, set_numbers, failed):
+		if self.sender() is not self.worker:
+			return
+		header = "set (run %s)" % (it_num + 1)
+		if failed:
+			header += " p < .2"
+		self.model.addSets(header, set_numbers)
+		self.statusBar().showMessage("Run %s of %s done" % (it_num + 1, self.worker.runs))
+
+	def showProgress(self, value):
+		if self.sender() is self.loader or self.sender() is self.worker:
+			self.progressBar.setValue(value)
+
+	def showError(self, message):
+		if self.sender() is self.loader or self.sender() is self.worker:
+			QtWidgets.QMessageBox.warning(self, "Discuit", message)
+
+	def start(self, thread, steps, message):
+		# keep a reference to the thread until it is done, also when it is cancelled
+		self.threads.append(thread)
+		thread.finished.connect(lambda: self.stopped(thread))
+		self.progressBar.setRange(0, steps)
+		self.progressBar.setValue(0)
+		self.progressBar.show()
+		self.statusBar().showMessage(message)
+		self.splitButton.setEnabled(False)
+		self.cancelButton.setEnabled(True)
+		thread.start()
+
+	def stopped(self, thread):
+		self.threads.remove(thread)
+		if thread is self.loader or thread is self.worker:
+			self.progressBar.hide()
+			self.cancelButton.setEnabled(False)
+			self.splitButton.setEnabled(self.data is not None)
 
-			#add choices on top of data
-			variables = list(self.model.fileContents.columns)		
-			
-			boxes = []
-			box = []
-			for variable in variables:
-				box.append('ignore')
-			
-			boxes.append(box)
-			table = pd.DataFrame(boxes, columns=list(self.model.fileContents.columns))	
-			table = pd.concat([table, data], ignore_index=True)
+	def cancel(self):
+		# the threads stop at the next chunk or run
+		for thread in (self.loader, self.worker):
+			if thread is not None and thread.isRunning():
+				thread.requestInterruption()
+				self.statusBar().showMessage("Cancelled")
+		self.loader = None
+		self.worker = None
+		self.progressBar.hide()
+		self.cancelButton.setEnabled(False)
+		self.splitButton.setEnabled(self.data is not None)
 
-			self.refreshAll(table, variables)
+	def closeEvent(self, event):
+		for thread in self.threads:
+			thread.requestInterruption()
+			thread.wait()
+		super().closeEvent(event)
 
 
 
 app = QtWidgets.QApplication(sys.argv)
 window = MainWindow()
 window.show()
-app.exec_()
\ No newline at end of file
+app.exec_()
@@ -12,404 +12,1829 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # TODO: work with missing data
-# TODO: maybe include more than 1 absolute variable?
 
-from typing import List
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from operator import add, mul
+from typing import List, NamedTuple
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+import cProfile
+import hashlib
+import heapq
+import json
+import os
 import sys
-from scipy.stats import kruskal, chi2_contingency
+import time
+import zipfile
+from scipy.stats import chi2, rankdata, tiecorrect
 from sklearn import metrics
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.preprocessing import MinMaxScaler
 from kmodes.kprototypes import KPrototypes
 from kmodes.kmodes import KModes
+from kmodes.util import encode_features
+from threadpoolctl import threadpool_limits
 import argparse
 import pathlib
 
-# check whether path and number of sets arguments were provided
-parser = argparse.ArgumentParser()
-parser.add_argument('datapath', type=pathlib.Path, help='path to input data file (csv)')
-parser.add_argument('sets', type=int, help='provide number of desired sets')
-parser.add_argument('--columns', nargs='*',
-                    choices=['l', 'c', 'n', 'a', 'd'],
-                    help='provide the data type for each column (l(abel)/c(ategorical)'
-                         '/n(umerical)/a(bsolute)/d(isregard).'
-                         'The number of labels needs to match the number of columns'
-                         ' in your input file. If this is not the case you can provide '
-                         'them later on and your input will be ignored.'
-                         '"Label" and "absolute" can only be specified once.',
-                    default=None)
-parser.add_argument('--runs', type=int,
-                         help='indicate how many different output options you want to generate',
-                    default=1)
-args = parser.parse_args()
-no_sets = int(sys.argv[2])
-
-# read file and check if it's suitable
-# noinspection PyBroadException
-try:
-    inputD = pd.read_csv(sys.argv[1])
-    fileName = pathlib.Path(sys.argv[1]).with_suffix('').name
-except FileNotFoundError:
-    print("File not found.")
-    sys.exit(1)  # abort
-except pd.errors.EmptyDataError:
-    print("No data")
-    sys.exit(1)  # abort
-except pd.errors.ParserError:
-    print("Parse error")
-    sys.exit(1)  # abort
-except Exception:
-    print("Something else went wrong. \n "
-          "Make sure your input looks as follows: \n"
-          "'model.py [path to csv file] [number of sets].'")
-    sys.exit(1)  # abort
+COLUMN_TYPES = ('l', 'c', 'n', 'a', 'd')
+# ways to choose the number of clusters per stratum (besides a fixed number)
+K_SELECTION = ('silhouette', 'elbow', 'rule')
+# ways to divide the clusters of a stratum in sets: balanced_sets or divide_in_sets
+ASSIGNMENTS = ('balanced', 'greedy')
 
-# The following info must come from user. In GUI this should be selected in the GUI after opening a file!
-categorical_features = []
-continuous_features = []
-absolute_features = []
-label = []
-disregard = []
-# number of runs provided as an argument. If nothing is provided it's 1. Also needs to come from GUI!
-iterations = args.runs
+# --profile: file that timings and counters are appended to as JSON lines, one event per line (None: off)
+profile_path = None
 
 
-# Check all the columns and ask about status. Label and absolute can only be chosen once.
-if args.columns == None or len(args.columns) != len(inputD.columns):
-    print("You didn't provide valid data type indications when running the program. Please specify them now")
-    for column in inputD.columns:
-        feature = None
-        while feature is None:
-            input_value = input("Is '" + column + "' the label (can only be assigned once), a categorical, "
-                                                  "numerical or absolute (can be assigned once) variable "
-                                                  "or should it be disregarded in splitting? l/c/n/a/d ")
-            if input_value not in ('l', 'c', 'n', 'a', 'd'):
-                print("Please choose either l, c, n, a or d ")
-            else:
-                feature = input_value
-                if feature == "c":
-                    categorical_features.append(column)
-                elif feature == "n":
-                    continuous_features.append(column)
-                elif feature == "a":
-                    if len(absolute_features) > 0:
-                        print('You already have an absolute feature. Please choose something else.')
-                        feature = None
-                    else:
-                        absolute_features.append(column)
-                elif feature == "l":
-                    if len(label) > 0:
-                        print('You already have a label. Please choose something else.')
-                        feature = None
-                    else:
-                        label.append(column)
-                elif feature == "d":
-                    disregard.append(column)
-# if specified when running program, take them from there
-else:
-    for column in inputD.columns:
-        feature = args.columns[inputD.columns.get_loc(column)]
-        if feature == "c":
-            categorical_features.append(column)
-        elif feature == "n":
-            continuous_features.append(column)
-        elif feature == "a":
-            absolute_features.append(column)
-        elif feature == "l":
-            label.append(column)
-        elif feature == "d":
-            disregard.append(column)
-    if len(label) > 1:
-        print("More than one 'label' was specified. Please use -h to get help in providing suitable arguments")
-        sys.exit(1)  # abort
-    if len(absolute_features) > 1:
-        print(
-            "More than one 'absolute' variable was specified. Please use -h to get help in providing suitable arguments")
-        sys.exit(1)  # abort
+def set_profile_path(path):
+    # also used to pass the file on to worker processes
+    global profile_path
+    profile_path = path
 
 
-def prepare_data(data, continuous, categorical, label, disregard):
-    # remove label column & disregarded columns
-    if len(label) != 0:
-        data = data.drop([label[0]], axis=1)
-    if len(disregard) != 0:
-        data = data.drop(disregard, axis=1)
+def log_event(event, **fields):
+    if profile_path is None:
+        return
+    # every process appends whole lines, so events of parallel workers do not get mixed up
+    with open(profile_path, 'a') as f:
+        f.write(json.dumps(dict(event=event, pid=os.getpid(), **fields), default=str) + '\n')
+
+
+@contextmanager
+def timed(phase, **fields):
+    # wall and CPU time (of the whole process) of the code in the with block
+    if profile_path is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    yield
+    log_event('phase', phase=phase, wall=time.perf_counter() - wall, cpu=time.process_time() - cpu, **fields)
+
+
+def peak_memory():
+    # peak resident memory in MB of this process and of its finished child processes (None if unknown)
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return tuple(resource.getrusage(who).ru_maxrss / unit
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def prepare_column(values, continuous, categorical):
+    # the feature values of one column (a Series) as a new array; data itself is not changed
     # transform continuous data
-    if len(continuous) != 0:
+    if continuous:
         # TODO replace md with average
-        mms = MinMaxScaler()
-        data[continuous] = mms.fit_transform(data[continuous])
-    # make sure categorical data uses numbers (for silhouette score)
-    if len(categorical) != 0:
-        for feat in categorical:
-            if data[feat].dtype != "float64" and data[feat].dtype != "int64":
-                # find unique values
-                values = data[feat].unique()
-                i = 0
-                # replace values
-                for value in values:
-                    data[feat].replace(value, i, inplace=True)
-                    i=i+1
-        # TODO handle missing data
-    return data
+        return MinMaxScaler().fit_transform(values.to_numpy(dtype=np.float64)[:, None])[:, 0]
+    # categorical data as codes, also if it is numeric: the codes are small whole numbers, so they stay exact
+    # in a float32 matrix (and the silhouette score needs numbers)
+    if categorical:
+        # one pass over the column, codes in order of first appearance
+        return pd.factorize(values)[0]
+    return values.to_numpy()
+
+
+class Stratum(NamedTuple):
+    # value of the absolute feature shared by all rows of this stratum (its values, joined by " / ", if there
+    # are several absolute features)
+    name: object
+    # positions of its rows in the input
+    rows: np.ndarray
+    # its rows in the feature matrix are matrix[start:stop]
+    start: int
+    stop: int
+    # hash of its features, used to look up the cluster-count sweep
+    key: str
+
+
+class Prepared(NamedTuple):
+    # read-only feature matrix with the rows of every stratum next to each other
+    matrix: np.ndarray
+    # names of the columns of the matrix
+    columns: list
+    # columns of the matrix that hold categorical features
+    categorical_idx: list
+    strata: List[Stratum]
+
+    def features(self, stratum):
+        # a view on the rows of one stratum, not a copy
+        return self.matrix[stratum.start:stratum.stop]
+
+
+def absolute_codes(data, absolute, sort=False):
+    # One code per row for the combination of its values of the absolute features, and the name of every
+    # code: the value itself for one feature, the values joined by " / " for several. Codes are in order of
+    # first appearance, or of the (sorted) values with sort. The codes of every next feature are combined
+    # with the codes so far and factorized again, so they stay below the number of rows, however many
+    # features and combinations there are. Missing values are a value of their own (an instance of the absolute
+    # variable like any other), also so that they cannot be mixed up with another code.
+    if len(absolute) == 1:
+        return pd.factorize(data[absolute[0]], sort=sort, use_na_sentinel=False)
+    codes = np.zeros(len(data), dtype=np.int64)
+    values = []
+    for feature in absolute:
+        feature_codes, feature_names = pd.factorize(data[feature], sort=sort, use_na_sentinel=False)
+        codes, combinations = pd.factorize(codes * len(feature_names) + feature_codes, sort=sort)
+        values = [feature_values[combinations // len(feature_names)] for feature_values in values]
+        values.append(np.asarray(feature_names, dtype=object)[combinations % len(feature_names)])
+    return codes, [" / ".join(str(value) for value in combination) for combination in zip(*values)]
+
+
+def prepare(data, continuous, categorical, label, disregard, absolute, dtype=np.float64):
+    # All preprocessing that does not depend on the attempt, done once. The feature matrix is filled one
+    # column at a time, so no prepared copy of the whole data is made besides the matrix itself (of dtype,
+    # float32 in low-memory mode).
+    # split by the "absolute" features and remove them from clustering
+    if len(absolute) > 0:
+        codes, names = absolute_codes(data, absolute, sort=True)
+    else:
+        codes, names = np.zeros(len(data), dtype=np.intp), ["overall"]
+    order = np.argsort(codes, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(names)))])
+
+    # remove label column, disregarded columns and the absolute features
+    columns = [column for column in data.columns if column not in label[:1] + disregard + absolute]
+    with timed('prepare_data', rows=len(data)):
+        matrix = np.empty((len(data), len(columns)), dtype=dtype)
+        for i, column in enumerate(columns):
+            matrix[:, i] = prepare_column(data[column], column in continuous, column in categorical)[order]
+    matrix.flags.writeable = False
+    categorical_idx = [columns.index(col) for col in categorical]
+
+    strata = []
+    for i, name in enumerate(names):
+        features = matrix[bounds[i]:bounds[i + 1]]
+        strata.append(Stratum(name, order[bounds[i]:bounds[i + 1]], bounds[i], bounds[i + 1],
+                              sweep_key(features, categorical_idx)))
+    return Prepared(matrix, columns, categorical_idx, strata)
+
+
+class Sweep(NamedTuple):
+    # number of clusters with the largest silhouette score
+    k: int
+    # the fitted model for that number of clusters
+    model: object
+    # fitted models for every number of clusters tried (only if asked for)
+    models: dict
+
+
+# outcome of the cluster-count sweep per prepared stratum, shared by all attempts and runs in this process
+sweep_cache = {}
+
+
+def sweep_key(features, categorical_idx):
+    key = hashlib.sha1(np.ascontiguousarray(features))
+    key.update(repr((features.shape, categorical_idx)).encode())
+    return key.hexdigest()
+
+
+def draw_sample(n, sample_size, random_state):
+    # rows to fit the clustering on in large-data mode, or None to fit on all rows
+    if sample_size is None or n <= sample_size:
+        return None
+    return np.sort(random_state.choice(n, sample_size, replace=False))
+
+
+# k-prototypes and k-modes fits of fewer rows start from one initialization instead of several: a small
+# stratum has few different clusterings, and with thousands of strata the extra starts take most of the time
+SINGLE_INIT_ROWS = 50
+
+
+def fit_clusters(features, k, categorical_idx, random_state=None, init=None, sample=None):
+    # With a sample (large-data mode), k-prototypes and k-modes are fitted on the sampled rows only and all
+    # rows are then assigned to their nearest prototype; k-means is fitted on all rows in mini-batches of
+    # the sample's size.
+    if sample is not None and len(categorical_idx) != 0:
+        model = fit_clusters(features[sample], k, categorical_idx, random_state, init)
+        model.labels_ = assign_clusters(model, features, categorical_idx)
+        return model
+
+    # kmodes prototype for mixed numerical and categorical data
+    if 0 < len(categorical_idx) < features.shape[1]:
+        if init is None:
+            model = KPrototypes(n_clusters=k, max_iter=20, n_init=1 if len(features) < SINGLE_INIT_ROWS else 10,
+                                random_state=random_state)
+        else:
+            model = KPrototypes(n_clusters=k, max_iter=20, init=init, n_init=1, random_state=random_state)
+        model.fit_predict(features, categorical=categorical_idx)
+        # kmodes skips iterating (and leaves no labels) if there are no more unique rows than clusters
+        if model.labels_ is None:
+            model.labels_ = model.predict(features, categorical=categorical_idx)
+    elif len(categorical_idx) != 0:
+        if init is None:
+            model = KModes(n_clusters=k, init="random", n_init=1 if len(features) < SINGLE_INIT_ROWS else 5,
+                           random_state=random_state)
+        else:
+            model = KModes(n_clusters=k, init=init, n_init=1, random_state=random_state)
+        model.fit_predict(features)
+        if model.labels_ is None:
+            model.labels_ = model.predict(features)
+    elif sample is not None:
+        model = MiniBatchKMeans(n_clusters=k, init='k-means++' if init is None else init, n_init=1,
+                                batch_size=len(sample), random_state=random_state)
+        model.fit(features)
+    else:
+        if init is None:
+            model = KMeans(n_clusters=k, init='k-means++', n_init=1, random_state=random_state)
+        else:
+            model = KMeans(n_clusters=k, init=init, n_init=1, random_state=random_state)
+        model.fit_predict(features)
+    return model
+
+
+def assign_clusters(model, features, categorical_idx, chunk_size=65536):
+    # nearest prototype of every row, computed a chunk of rows at a time so memory use stays bounded;
+    # uses the same dissimilarity as the fitted k-prototypes or k-modes model
+    labels = np.empty(len(features), dtype=np.intp)
+    centroids = model.cluster_centroids_.astype(np.float64)
+    numerical_idx = [i for i in range(features.shape[1]) if i not in categorical_idx]
+    if len(numerical_idx) != 0:
+        # k-prototypes keeps the numerical attributes of its centroids first
+        num_centroids = centroids[:, :len(numerical_idx)]
+        cat_centroids = centroids[:, len(numerical_idx):]
+    else:
+        cat_centroids = centroids
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start:start + chunk_size]
+        cost = (chunk[:, None, categorical_idx] != cat_centroids[None]).sum(axis=2).astype(np.float64)
+        if len(numerical_idx) != 0:
+            cost *= model.gamma
+            cost += ((chunk[:, None, numerical_idx] - num_centroids[None]) ** 2).sum(axis=2)
+        labels[start:start + chunk_size] = cost.argmin(axis=1)
+    return labels
+
+
+def warm_init(model, features, categorical_idx):
+    # centroids for one more cluster: the current ones plus the item that fits its own cluster worst.
+    # kmodes expects initial categorical centroids in its own encoding, which the fitted model keeps.
+    if 0 < len(categorical_idx) < features.shape[1]:
+        numerical_idx = [i for i in range(features.shape[1]) if i not in categorical_idx]
+        x_num = features[:, numerical_idx]
+        x_cat, _ = encode_features(features[:, categorical_idx], enc_map=model._enc_map)
+        num_centroids, cat_centroids = model._enc_cluster_centroids
+        cost = (((x_num - num_centroids[model.labels_]) ** 2).sum(axis=1)
+                + model.gamma * (x_cat != cat_centroids[model.labels_]).sum(axis=1))
+        worst = np.argmax(cost)
+        return [np.vstack([num_centroids, x_num[worst]]), np.vstack([cat_centroids, x_cat[worst]])]
+    elif len(categorical_idx) != 0:
+        x_cat, _ = encode_features(features, enc_map=model._enc_map)
+        centroids = model._enc_cluster_centroids
+        worst = np.argmax((x_cat != centroids[model.labels_]).sum(axis=1))
+        return np.vstack([centroids, x_cat[worst]])
+    else:
+        worst = np.argmax(model.transform(features).min(axis=1))
+        return np.vstack([model.cluster_centers_, features[worst]])
+
+
+def pairwise_dissimilarities(features, categorical_idx, block_size=256):
+    # Dissimilarities between all rows of features, in the measure the clusterer itself uses: the number of
+    # mismatching categories (k-modes), squared Euclidean distance plus gamma times the mismatches
+    # (k-prototypes; gamma is only known after fitting, so both parts are returned separately) or
+    # Euclidean distance (k-means). Computed a block of rows at a time, so apart from the result itself
+    # memory use stays bounded. Returns the numerical and the categorical part (None if there is none).
+    numerical_idx = [i for i in range(features.shape[1]) if i not in categorical_idx]
+    numerical = np.empty((len(features), len(features))) if len(numerical_idx) != 0 else None
+    categorical = np.empty((len(features), len(features))) if len(categorical_idx) != 0 else None
+    for start in range(0, len(features), block_size):
+        block = features[start:start + block_size]
+        if numerical is not None:
+            numerical[start:start + block_size] = metrics.pairwise.euclidean_distances(
+                block[:, numerical_idx], features[:, numerical_idx], squared=categorical is not None)
+        if categorical is not None:
+            categorical[start:start + block_size] = (block[:, None, categorical_idx]
+                                                     != features[None, :, categorical_idx]).sum(axis=2)
+    if numerical is not None:
+        # rounding can leave tiny distances between a row and itself
+        np.fill_diagonal(numerical, 0)
+    return numerical, categorical
 
 
-def clustering(transformed_data, categorical_features, continuous_features):
-    # determine max number of clusters...
-    max_clus = int(len(transformed_data) * .5)
+def silhouette(dissimilarities, labels, gamma=None):
+    # Mean silhouette coefficient of the rows that dissimilarities (from pairwise_dissimilarities) is for,
+    # the same as sklearn's silhouette_score with a precomputed metric. Returns -1 (the worst score) if
+    # there are fewer than 2 clusters or no cluster has more than one row.
+    numerical, categorical = dissimilarities
+    if categorical is None:
+        distances = numerical
+    elif numerical is None:
+        distances = categorical
+    else:
+        distances = numerical + gamma * categorical
+    names, codes, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    if not 2 <= len(names) < len(labels):
+        return -1
+    rows = np.arange(len(labels))
+    # summed dissimilarity of every row to the rows of every cluster
+    sums = distances @ (codes[:, None] == np.arange(len(names))).astype(np.float64)
+    own = counts[codes]
+    a = sums[rows, codes] / np.maximum(own - 1, 1)
+    sums[rows, codes] = np.inf
+    b = (sums / counts).min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.nan_to_num((b - a) / np.maximum(a, b))
+    # a row that is alone in its cluster scores 0
+    scores[own == 1] = 0
+    return scores.mean()
+
+
+def elbow(cl_range, models):
+    # The knee of the fit cost (k-means inertia or k-modes/k-prototypes cost) against the number of
+    # clusters: the k whose cost lies furthest below the straight line from the first to the last k.
+    # Returns the position of that k in cl_range.
+    costs = np.array([model.inertia_ if hasattr(model, 'inertia_') else model.cost_ for model in models])
+    if len(costs) < 3 or costs[0] == costs[-1]:
+        return 0
+    x = np.linspace(0, 1, len(costs))
+    y = (costs - costs[-1]) / (costs[0] - costs[-1])
+    return int(np.argmax((1 - x) - y))
+
+
+def rule_of_thumb_k(n, cl_range):
+    # k = sqrt(n / 2), kept within the numbers of clusters the sweep would try
+    if len(cl_range) == 0:
+        return cl_range
+    k = min(max(int(round(np.sqrt(n / 2))), cl_range[0]), cl_range[-1])
+    return range(k, k + 1)
+
+
+def could_not_initialize(error):
+    # kmodes gives up on k-prototypes and k-modes fits whose initial clusters keep coming out the same,
+    # which happens for small strata with few distinct rows
+    return isinstance(error, ValueError) and 'could not initialize' in str(error)
+
+
+def _sweep_fit(features, k, categorical_idx, seed, init=None, sample=None):
+    # the fitted model, or None if the fit could not be initialized
+    random_state = np.random.RandomState(seed)
+    with timed('fit', k=k, rows=len(features), sweep=True):
+        try:
+            return fit_clusters(features, k, categorical_idx, random_state, init, sample)
+        except ValueError as e:
+            if not could_not_initialize(e):
+                raise
+            log_event('fit_failed', k=k, rows=len(features), sweep=True)
+            return None
+
+
+def sweep_cache_key(key, sample_size, silhouette_size, k_select, warm_start=False, keep_models=False):
+    # every setting that changes the outcome of a sweep (or, keep_models, what it holds)
+    return key, sample_size, silhouette_size if k_select == 'silhouette' else None, k_select, warm_start, keep_models
+
+
+def sweep_plan(features, key, sample_size=None, k_select='silhouette'):
+    # the numbers of clusters the sweep fits, the seed of every fit and the rows to fit on (None: all)
+    max_clus = int(len(features) * .5)
     if max_clus > 10:
         max_clus = 10
     cl_range = range(2, max_clus)  # changed to max 10 clusters to keep speed, check which max is appropriate
-    # kmodes prototype for mixed numerical and categorical data
-    largest_sil = (0, -1)
+    if k_select == 'rule':
+        cl_range = rule_of_thumb_k(len(features), cl_range)
+    elif k_select not in K_SELECTION:
+        cl_range = range(min(k_select, len(features)), min(k_select, len(features)) + 1)
+    # the sweep is seeded by the data, so its outcome does not depend on which attempt runs it first
+    seeds = [[int(key[:8], 16), k] for k in cl_range]
+    # in large-data mode, every k is fitted on the same sample
+    sample = draw_sample(len(features), sample_size, np.random.RandomState(int(key[:8], 16)))
+    return cl_range, seeds, sample
 
-    # this needs to be adjusted depending on input
-    categorical_features_idx = [transformed_data.columns.get_loc(col) for col in categorical_features]
-    mark_array = transformed_data.values
 
-    # choose algorithm depending on input
-    if (len(categorical_features) != 0) and (len(continuous_features) != 0):
-        for k in cl_range:
-            kproto = KPrototypes(n_clusters=k, max_iter=20)
-            kproto.fit_predict(mark_array, categorical=categorical_features_idx)
-            sil = metrics.silhouette_score(transformed_data, kproto.labels_, sample_size=1000)
+def choose_k(features, categorical_idx, keep_models=False, jobs=1, warm_start=False, key=None, sample_size=None,
+             silhouette_size=1000, k_select='silhouette'):
+    # silhouette_size: number of rows the silhouette score is computed on (None: all rows)
+    # k_select: 'silhouette' (fit every k and keep the best silhouette score), 'elbow' (fit every k and
+    # keep the knee of the fit cost), 'rule' (only fit k = sqrt(n / 2)) or a fixed number of clusters
+    if key is None:
+        key = sweep_key(features, categorical_idx)
+    cache_key = sweep_cache_key(key, sample_size, silhouette_size, k_select, warm_start, keep_models)
+    if cache_key in sweep_cache:
+        return sweep_cache[cache_key]
 
-            if sil > largest_sil[1]:
-                largest_sil = (k, sil)
+    cl_range, seeds, sample = sweep_plan(features, key, sample_size, k_select)
+    if warm_start:
+        # each k starts from the centroids of k-1, so the fits have to run one after another
+        fits = []
+        init = None
+        for k, seed in zip(cl_range, seeds):
+            fits.append(_sweep_fit(features, k, categorical_idx, seed, init, sample))
+            init = None if fits[-1] is None else warm_init(fits[-1], features, categorical_idx)
+    elif jobs > 1 and len(cl_range) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(cl_range)), initializer=set_profile_path,
+                                 initargs=(profile_path,)) as pool:
+            fits = list(pool.map(_sweep_fit, [features] * len(cl_range), cl_range,
+                                 [categorical_idx] * len(cl_range), seeds, [None] * len(cl_range),
+                                 [sample] * len(cl_range)))
+    else:
+        fits = [_sweep_fit(features, k, categorical_idx, seed, sample=sample) for k, seed in zip(cl_range, seeds)]
+    sweep_cache[cache_key] = select_k(features, categorical_idx, cl_range, fits, key, keep_models, silhouette_size,
+                                      k_select)
+    return sweep_cache[cache_key]
 
-        kproto_final = KPrototypes(n_clusters=largest_sil[0], max_iter=20)
 
-        pred_cluster = kproto_final.fit_predict(mark_array, categorical=categorical_features_idx)
+def select_k(features, categorical_idx, cl_range, fits, key, keep_models=False, silhouette_size=1000,
+             k_select='silhouette'):
+    # The outcome of a sweep, given the fitted model for every number of clusters in cl_range (None for
+    # fits that could not be initialized). Without any fitted model (also if cl_range is empty, for
+    # strata too small to cluster), k is 0 and the stratum is used as one cluster.
+    models = {k: model for k, model in zip(cl_range, fits) if model is not None}
+    cl_range, fits = list(models), list(models.values())
+    largest_sil = (0, -1, None)
+    if k_select == 'silhouette' and len(fits) != 0:
+        # every k is scored on the same rows, so their dissimilarities are only computed once
+        scored = draw_sample(len(features), silhouette_size, np.random.RandomState([int(key[:8], 16), 0]))
+        if scored is None:
+            scored = np.arange(len(features))
+        with timed('dissimilarities', rows=len(scored)):
+            dissimilarities = pairwise_dissimilarities(features[scored], categorical_idx)
 
-    elif (len(categorical_features) != 0) and (len(continuous_features) == 0):
-        for k in cl_range:
-            kmode = KModes(n_clusters=k, init="random", n_init=5)
-            kmode.fit_predict(transformed_data)
-            sil = metrics.silhouette_score(transformed_data, kmode.labels_, sample_size=1000)
+        for k, model in zip(cl_range, fits):
+            with timed('silhouette', k=k, rows=len(scored)):
+                sil = silhouette(dissimilarities, model.labels_[scored], getattr(model, 'gamma', None))
             if sil > largest_sil[1]:
-                largest_sil = (k, sil)
-        kmode_final = KModes(n_clusters=largest_sil[0], init="random", n_init=5)
-        pred_cluster = kmode_final.fit_predict(transformed_data)
+                largest_sil = (k, sil, model)
+    elif len(fits) != 0:
+        # no silhouette scores: the knee of the fit cost, or the only k that was fitted
+        best = elbow(cl_range, fits) if k_select == 'elbow' else 0
+        largest_sil = (cl_range[best], None, fits[best])
+
+    if not keep_models:
+        models = {}
+    log_event('sweep', key=key[:12], rows=len(features), k_select=k_select, k=largest_sil[0],
+              silhouette=largest_sil[1])
+    return Sweep(largest_sil[0], largest_sil[2], models)
+
+
+def clustering(features, categorical_idx, random_state=None, keep_models=False, jobs=1, warm_start=False,
+               key=None, sample_size=None, silhouette_size=1000, k_select='silhouette'):
+    # The number of clusters only depends on the data, so per attempt only the final model is fitted
+    # with the attempt's own seed. Without a seed, the best model of the sweep is used as it is.
+    # Returns the members of every cluster as positions in features.
+    sweep = choose_k(features, categorical_idx, keep_models, jobs, warm_start, key, sample_size, silhouette_size,
+                     k_select)
+    k = sweep.k
+    if k == 0:
+        return [np.arange(len(features))]
+    if random_state is None:
+        pred_cluster = sweep.model.labels_
     else:
-        for k in cl_range:
-            km = KMeans(n_clusters=k, n_init=1, init='k-means++')
-            km.fit_predict(transformed_data)
-            sil = metrics.silhouette_score(transformed_data, km.labels_, sample_size=1000)
-            if sil > largest_sil[1]:
-                largest_sil = (k, sil)
-        km_final = KMeans(n_clusters=largest_sil[0], init='k-means++', n_init=1)
-        pred_cluster = km_final.fit_predict(transformed_data)
+        sample = draw_sample(len(features), sample_size, random_state)
+        with timed('fit', k=k, rows=len(features), sweep=False):
+            try:
+                pred_cluster = fit_clusters(features, k, categorical_idx, random_state, sample=sample).labels_
+            except ValueError as e:
+                if not could_not_initialize(e):
+                    raise
+                # the sweep did fit this number of clusters, so its model is used for this attempt
+                log_event('fit_failed', k=k, rows=len(features), sweep=False)
+                pred_cluster = sweep.model.labels_
 
-    clusters: List[List[int]] = [[] for _ in range(largest_sil[0])]
+    # members of every cluster in order: a stable sort by cluster, cut at the cluster sizes
+    members = np.argsort(pred_cluster, kind='stable')
+    return np.split(members, np.cumsum(np.bincount(pred_cluster, minlength=k))[:-1])
 
-    for item in range(0, len(pred_cluster)):
-        clusters[pred_cluster[item]].append(item)
 
-    final_clusters = []
+def divide_in_sets(clusters, set_sizes):
+    # Divide clusters evenly amongst desired sets: every item goes to the set that is smallest at that
+    # moment (the first one on ties). set_sizes is updated in place. Returns the set (0-based) of every
+    # item, in the order of the items in the clusters.
+    smallest = [(size, s_set) for s_set, size in enumerate(set_sizes)]
+    heapq.heapify(smallest)
+    sets = np.empty(sum(len(cluster) for cluster in clusters), dtype=np.intp)
+    for item in range(len(sets)):
+        size, s_set = smallest[0]
+        sets[item] = s_set
+        heapq.heapreplace(smallest, (size + 1, s_set))
+    set_sizes += np.bincount(sets, minlength=len(set_sizes))
+    return sets
 
-    for cluster in clusters:
-        cluster_new = []
-        for item in cluster:
-            cluster_new.append(transformed_data.iloc[item].name)
-        final_clusters.append(cluster_new)
-    return final_clusters
 
+def balanced_sets(clusters, set_sizes, features, categorical_idx):
+    # Like divide_in_sets, every item goes to one of the sets that are smallest at that moment, but of those
+    # to the set it balances best: the set whose running sums of the (centred) ranks of the numerical
+    # features are most opposite to the item's, and that has the fewest items of the item's categories so
+    # far. The items of a cluster are dealt from the most extreme to the most central one, so the last items
+    # even out what is left. set_sizes is updated in place. Returns the set (0-based) of every item, in the
+    # order of the items in the clusters.
+    n = len(features)
+    numerical = np.delete(features, categorical_idx, axis=1)
+    # ranks, as the Kruskal-Wallis test uses them, centred on 0 and scaled to -.5 .. .5
+    numerical = (rankdata(numerical, axis=0) - (n + 1) / 2) / n
+    codes = np.empty((n, len(categorical_idx)), dtype=np.intp)
+    for i, column in enumerate(categorical_idx):
+        codes[:, i] = np.unique(features[:, column], return_inverse=True)[1]
 
-def divide_in_sets(clusters, output_sets):
-    # divide clusters evenly amongst desired sets
-    for cluster in clusters:
-        for item in cluster:
-            output_sets[output_sets.index(min(output_sets, key=len))].append(item)
+    # the order the items are dealt in: cluster by cluster, from the most extreme to the most central item,
+    # as positions in the returned array
+    dealt = [offset + np.argsort(-np.abs(numerical[cluster]).sum(axis=1), kind='stable')
+             for offset, cluster in zip(np.cumsum([0] + [len(cluster) for cluster in clusters]),
+                                        (np.asarray(cluster, dtype=np.intp) for cluster in clusters))]
+    if sum(len(positions) for positions in dealt) == 0:
+        return np.empty(0, dtype=np.intp)
+    dealt = np.concatenate(dealt)
+    items = np.concatenate(clusters).astype(np.intp)[dealt]
+    # the features of the items in the order they are dealt, and one column per category of every categorical
+    # feature in the counts, so that every round works on slices
+    numerical = numerical[items]
+    codes = codes[items] + np.concatenate([[0], np.cumsum(codes.max(axis=0)[:-1] + 1)]).astype(np.intp)
 
+    # Every item depends on the ones before it, and per item the sums are only a few numbers, so this loop
+    # works on plain lists: a numpy call per item takes longer than its arithmetic.
+    sums = [[0.0] * numerical.shape[1] for _ in set_sizes]
+    counts = [[0] * (int(codes.max()) + 1 if codes.size else 0) for _ in set_sizes]
+    sizes = set_sizes.tolist()
+    chosen = []
+    smallest = []
+    for x, item_codes in zip(numerical.tolist(), codes.tolist()):
+        if not smallest:
+            # a new round: each of the sets that are smallest now gets one of the next items
+            least = min(sizes)
+            smallest = [s_set for s_set, size in enumerate(sizes) if size == least]
+        cost = [sum(map(mul, sums[s_set], x)) + sum(map(counts[s_set].__getitem__, item_codes))
+                for s_set in smallest]
+        # the set with the lowest cost (the first one on ties)
+        best = smallest.pop(cost.index(min(cost)))
+        chosen.append(best)
+        sums[best] = list(map(add, sums[best], x))
+        for code in item_codes:
+            counts[best][code] += 1
+        sizes[best] += 1
+    sets = np.empty(len(items), dtype=np.intp)
+    sets[dealt] = chosen
+    set_sizes[:] = sizes
+    return sets
+
+
+class TestGroup(NamedTuple):
+    # absolute variable instance the tests are for, or "overall"
+    name: object
+    # positions of its rows in the input
+    rows: np.ndarray
+    # twice the ranks of the continuous features within the group (one column per feature), ties get their
+    # mean rank; doubled, every rank is a whole number, stored exactly in an unsigned integer type
+    ranks: np.ndarray
+    # tie correction factor per continuous feature
+    ties: np.ndarray
+    # category codes of the categorical features, one column per feature
+    codes: np.ndarray
+    # number of codes of the categorical feature with the most categories
+    no_codes: int
 
-def split(absolute, data):
-    try:
-        grouped = data.groupby(absolute)
-    except KeyError:
-        print('You listed an absolute variable that cannot be found in the input file')
-        sys.exit(1)  # abort
 
-    data_splitted = []
-    for name, group in grouped:
-        # drop absolute columns from further analysis
-        data_x = group.drop(columns=absolute)
-        data_splitted.append(data_x)
+def test_groups(data, continuous, categorical, absolute):
+    # everything the tests need that does not depend on the split, computed once
+    factorized = [pd.factorize(data[feat])[0] for feat in categorical]
+    no_codes = max((int(feat_codes.max()) + 1 for feat_codes in factorized if len(feat_codes)), default=0)
+    # the smallest signed type (missing values would get code -1, but Splitter does not allow them)
+    codes = np.empty((len(data), len(categorical)), dtype=np.min_scalar_type(-no_codes - 1))
+    for i, feat_codes in enumerate(factorized):
+        codes[:, i] = feat_codes
+    del factorized
 
-    return data_splitted
+    groups = []
+    if len(absolute) > 0:
+        subset_codes, subsets = absolute_codes(data, absolute)
+        order = np.argsort(subset_codes, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(subset_codes, minlength=len(subsets)))])
+        for i, subset in enumerate(subsets):
+            groups.append((subset, order[bounds[i]:bounds[i + 1]]))
+    groups.append(("overall", np.arange(len(data))))
 
+    rank_dtype = np.uint32 if 2 * len(data) <= np.iinfo(np.uint32).max else np.uint64
+    ranks = [np.empty((len(rows), len(continuous)), dtype=rank_dtype) for _, rows in groups]
+    ties = [np.empty(len(continuous)) for _ in groups]
+    # one feature at a time, which keeps the temporary arrays of rankdata small, and every feature is only
+    # read from the data once, however many absolute variable instances there are
+    for i, feat in enumerate(continuous):
+        values = data[feat].to_numpy(dtype=np.float64)
+        for g, (_, rows) in enumerate(groups):
+            # the overall group (or a single absolute variable instance) has all rows in order, so it needs no copy
+            feat_ranks = rankdata(values if len(rows) == len(data) else values[rows])
+            ranks[g][:, i] = 2 * feat_ranks
+            ties[g][i] = tiecorrect(feat_ranks)
+    return [TestGroup(name, rows, ranks[g], ties[g], codes if len(rows) == len(data) else codes[rows], no_codes)
+            for g, (name, rows) in enumerate(groups)]
 
-def kwtest(label, features, sets, data):
+
+def kwtest(group, features, sets, present):
+    # Kruskal-Wallis test per feature, the same as scipy.stats.kruskal on the sets that appear in the split.
+    # sets holds the set (0-based) of every row of the group, present marks the sets that appear anywhere.
     stats = []
-    df = len(sets) - 1
-    for feat in features:
-        kw_input = []
-        for s_set in sets:
-            list = data.loc[data.set_number == s_set, feat].tolist()
-            kw_input.append(list)
-        stat, p = kruskal(*kw_input)
-        stats.append([label, "Kruskal-Wallis test", feat, stat, df, p])
+    if len(features) == 0:
+        return stats
+    df = present.sum() - 1
+    n = len(sets)
+    counts = np.bincount(sets, minlength=len(present))[present]
+    # rank sums per set, one feature at a time so that no temporary array is larger than a column
+    rank_sums = np.column_stack([np.bincount(sets, weights=group.ranks[:, i], minlength=len(present))
+                                 for i in range(len(features))])[present] / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = (12 / (n * (n + 1)) * (rank_sums ** 2 / counts[:, None]).sum(axis=0) - 3 * (n + 1)) / group.ties
+    # like scipy, no result for an empty set or a feature that has the same value everywhere
+    h[(counts == 0).any() | (group.ties == 0)] = np.nan
+    p = chi2.sf(h, df)
+    for i, feat in enumerate(features):
+        stats.append([group.name, "Kruskal-Wallis test", feat, h[i], df, p[i]])
     return stats
 
 
-def chi(label, features, data):
+def chi(group, features, sets, no_sets):
+    # chi-square test per feature, the same as scipy.stats.chi2_contingency on the crosstab of feature and set
     stats = []
-    for feat in features:
-        data_crosstab = pd.crosstab(data[feat],
-                                    data['set_number'])
-        stat, p, dof, expected = chi2_contingency(data_crosstab, correction=True)
-        stats.append([label, "Chi2-Test", feat, stat, dof, p])
+    if len(features) == 0:
+        return stats
+    # contingency tables of all features, padded to the feature with the most categories
+    observed = np.stack([np.bincount(group.codes[:, i] * no_sets + sets, minlength=group.no_codes * no_sets)
+                         for i in range(len(features))]).reshape(len(features), group.no_codes, no_sets)
+    observed = observed.astype(np.float64)
+    row_totals = observed.sum(axis=2)
+    column_totals = observed.sum(axis=1)
+    expected = row_totals[:, :, None] * column_totals[:, None, :] / len(sets)
+    # categories and sets that do not occur are not part of the crosstab
+    dof = ((row_totals > 0).sum(axis=1) - 1) * ((column_totals > 0).sum(axis=1) - 1)
+
+    # Yates' correction for tables with one degree of freedom
+    yates = (dof == 1)[:, None, None]
+    difference = expected - observed
+    observed = np.where(yates, observed + np.sign(difference) * np.minimum(0.5, np.abs(difference)), observed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(expected > 0, (observed - expected) ** 2 / expected, 0)
+    stat = terms.sum(axis=(1, 2))
+    stat[dof == 0] = 0
+    p = np.where(dof == 0, 1.0, chi2.sf(stat, np.maximum(dof, 1)))
+    for i, feat in enumerate(features):
+        stats.append([group.name, "Chi2-Test", feat, stat[i], dof[i], p[i]])
     return stats
 
 
-def statistics(data):
+def statistics(groups, set_numbers, continuous_features, categorical_features):
     stats_out = []
-    subsets = data[absolute_features[0]].unique()
-    sets = data.set_number.unique()
+    sets = np.asarray(set_numbers) - 1
+    no_sets = sets.max() + 1
+    present = np.bincount(sets, minlength=no_sets) > 0
 
-    for subset in subsets:
-        stats_frame = data.loc[data[absolute_features[0]] == subset]
-        stats_out.append(kwtest(subset, continuous_features, sets, stats_frame))
-        stats_out.append(chi(subset, categorical_features, stats_frame))
-
-    # overall stats
-    stats_out.append(kwtest("overall", continuous_features, sets, data))
-    stats_out.append(chi("overall", categorical_features, data))
+    # per absolute variable instance, then overall
+    for group in groups:
+        group_sets = sets[group.rows]
+        stats_out.append(kwtest(group, continuous_features, group_sets, present))
+        stats_out.append(chi(group, categorical_features, group_sets, no_sets))
     return stats_out
 
 
-def write_out(stats, i, significant, it_num):
+class SwapOptimizer:
+    '''
+    Improves a split by swapping items between sets within the same absolute variable instance, so that
+    the set sizes per instance stay the same. Rank sums and contingency tables are kept up to date with
+    every swap, which makes scoring a candidate swap O(features) instead of a new run of statistics().
+    Like TestGroup.ranks, the rank sums are kept doubled.
+
+    A split is scored by how far the test statistics are above the value that gives p = .2, summed over
+    all tests; a score of 0 means that every test has p >= .2.
+    '''
+
+    def __init__(self, groups, set_numbers, no_sets):
+        self.groups = groups
+        self.sets = np.asarray(set_numbers) - 1
+        self.no_sets = no_sets
+        present = np.bincount(self.sets, minlength=no_sets) > 0
+        self.df = present.sum() - 1
+
+        # the instance every row belongs to and its position in there; the last group is "overall"
+        self.group_of = np.full(len(self.sets), len(groups) - 1)
+        self.position = np.arange(len(self.sets))
+        for g, group in enumerate(groups[:-1]):
+            self.group_of[group.rows] = g
+            self.position[group.rows] = np.arange(len(group.rows))
+        self.members = [group.rows for group in groups[:-1]] or [groups[-1].rows]
+
+        self.rank_sums = []
+        self.counts = []
+        self.kw_critical = []
+        self.tables = []
+        self.expected = []
+        self.yates = []
+        self.chi_critical = []
+        self.kw_stats = []
+        self.chi_stats = []
+        for group in groups:
+            sets = self.sets[group.rows]
+            counts = np.bincount(sets, minlength=no_sets).astype(np.float64)
+            rank_sums = np.zeros((no_sets, group.ranks.shape[1]))
+            np.add.at(rank_sums, sets, group.ranks)
+            # like kwtest: no result for an empty set or a feature that has the same value everywhere
+            kw_valid = (group.ties > 0) & (counts[present] > 0).all()
+            self.counts.append(counts)
+            self.rank_sums.append(rank_sums)
+            self.kw_critical.append(np.where(kw_valid, chi2.isf(0.2, self.df), np.inf))
+            self.kw_stats.append(self._kw(g=len(self.rank_sums) - 1, rank_sums=rank_sums))
+
+            features = np.arange(group.codes.shape[1])[:, None]
+            table = np.zeros((group.codes.shape[1], group.no_codes, no_sets))
+            np.add.at(table, (features, group.codes.T, sets), 1)
+            row_totals = table.sum(axis=2)
+            column_totals = table.sum(axis=1)
+            dof = ((row_totals > 0).sum(axis=1) - 1) * ((column_totals > 0).sum(axis=1) - 1)
+            self.tables.append(table)
+            self.expected.append(row_totals[:, :, None] * column_totals[:, None, :] / len(sets))
+            self.yates.append(dof == 1)
+            self.chi_critical.append(np.where(dof > 0, chi2.isf(0.2, np.maximum(dof, 1)), np.inf))
+            self.chi_stats.append(self._cells(table, self.expected[-1], self.yates[-1][:, None, None]).sum(axis=(1, 2)))
+
+    def _kw(self, g, rank_sums):
+        # Kruskal-Wallis H from rank sums per set (the last two axes are sets and features)
+        n = len(self.groups[g].rows)
+        counts = self.counts[g][:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ssbn = np.where(counts > 0, (rank_sums / 2) ** 2 / counts, 0).sum(axis=-2)
+            return (12 / (n * (n + 1)) * ssbn - 3 * (n + 1)) / self.groups[g].ties
+
+    @staticmethod
+    def _cells(observed, expected, yates):
+        # contribution of contingency table cells to the chi-square statistic, with Yates' correction
+        # where chi() applies it
+        difference = np.abs(observed - expected)
+        difference = np.where(yates, np.maximum(difference - 0.5, 0), difference)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(expected > 0, difference ** 2 / expected, 0)
+
+    def _excess(self, g, kw_stats, chi_stats):
+        # tests without a result (nan) and tests that are left out (infinite critical value) count as passed
+        with np.errstate(invalid='ignore'):
+            return (np.fmax(kw_stats - self.kw_critical[g], 0).sum(axis=-1)
+                    + np.fmax(chi_stats - self.chi_critical[g], 0).sum(axis=-1))
+
+    def score(self):
+        return sum(self._excess(g, self.kw_stats[g], self.chi_stats[g]) for g in range(len(self.groups)))
+
+    def _swapped(self, g, i, candidates):
+        # statistics of group g for swapping item i with each of the candidates
+        group = self.groups[g]
+        a = self.sets[i]
+        b = self.sets[candidates]
+        pi = self.position[i] if g < len(self.groups) - 1 else i
+        pj = self.position[candidates] if g < len(self.groups) - 1 else candidates
+
+        # signed, so the differences below cannot wrap around
+        rank_i = group.ranks[pi].astype(np.float64)
+        rank_j = group.ranks[pj].astype(np.float64)
+        rank_sums = np.broadcast_to(self.rank_sums[g], (len(candidates),) + self.rank_sums[g].shape).copy()
+        rank_sums[:, a] += rank_j - rank_i
+        rank_sums[np.arange(len(candidates)), b] += rank_i - rank_j
+        kw_stats = self._kw(g, rank_sums)
+
+        table = self.tables[g]
+        expected = self.expected[g]
+        features = np.arange(table.shape[0])
+        code_i = group.codes[pi]
+        code_j = group.codes[pj]
+        changed = code_i != code_j
+        chi_stats = np.broadcast_to(self.chi_stats[g], changed.shape).copy()
+        b = b[:, None]
+        for code, column, change in ((code_i, a, -1), (code_i, b, 1), (code_j, b, -1), (code_j, a, 1)):
+            observed = table[features, code, column]
+            cell_expected = expected[features, code, column]
+            chi_stats += changed * (self._cells(observed + change, cell_expected, self.yates[g])
+                                    - self._cells(observed, cell_expected, self.yates[g]))
+        return kw_stats, chi_stats
+
+    def _swap(self, i, j, g, kw_stats, chi_stats):
+        group = self.groups[g]
+        a, b = self.sets[i], self.sets[j]
+        pi = self.position[i] if g < len(self.groups) - 1 else i
+        pj = self.position[j] if g < len(self.groups) - 1 else j
+        rank_i = group.ranks[pi].astype(np.float64)
+        rank_j = group.ranks[pj].astype(np.float64)
+        self.rank_sums[g][a] += rank_j - rank_i
+        self.rank_sums[g][b] += rank_i - rank_j
+        features = np.arange(group.codes.shape[1])
+        self.tables[g][features, group.codes[pi], a] -= 1
+        self.tables[g][features, group.codes[pi], b] += 1
+        self.tables[g][features, group.codes[pj], b] -= 1
+        self.tables[g][features, group.codes[pj], a] += 1
+        self.kw_stats[g] = kw_stats
+        self.chi_stats[g] = chi_stats
+
+    def run(self, budget, random_state, candidates=64):
+        # try up to 'budget' items, each against a sample of items of other sets in the same instance,
+        # and make the best swap if it lowers the score; stop as soon as every test passes
+        overall = len(self.groups) - 1
+        scores = [self._excess(g, self.kw_stats[g], self.chi_stats[g]) for g in range(len(self.groups))]
+        for step in range(budget):
+            if sum(scores) <= 0:
+                break
+            # look for items in instances that fail a test, or anywhere if only the overall tests fail
+            failing = [members for g, members in enumerate(self.members) if scores[g] > 0 and g != overall]
+            members = failing[random_state.randint(len(failing))] if failing else \
+                self.members[random_state.randint(len(self.members))]
+            i = members[random_state.randint(len(members))]
+            sample = members[random_state.randint(len(members), size=min(candidates, len(members)))]
+            sample = sample[self.sets[sample] != self.sets[i]]
+            if len(sample) == 0:
+                continue
+
+            affected = [self.group_of[i], overall] if self.group_of[i] != overall else [overall]
+            swapped = [self._swapped(g, i, sample) for g in affected]
+            new_scores = sum(self._excess(g, *stats) for g, stats in zip(affected, swapped))
+            best = np.argmin(new_scores)
+            if new_scores[best] < sum(scores[g] for g in affected):
+                j = sample[best]
+                for g, (kw_stats, chi_stats) in zip(affected, swapped):
+                    self._swap(i, j, g, kw_stats[best], chi_stats[best])
+                    scores[g] = self._excess(g, kw_stats[best], chi_stats[best])
+                self.sets[i], self.sets[j] = self.sets[j], self.sets[i]
+        return self.sets + 1
+
+
+class SplitResult(NamedTuple):
+    # set number (1-based) per row of the input, aligned to its index
+    set_numbers: pd.Series
+    # one list of [subset, test, feature, statistic, df, p] rows per test group
+    stats: list
+    # index of the attempt that produced this split (0-based)
+    iteration: int
+    # True if no attempt reached p >= .2 for all variables
+    significant: bool
+
+
+def check_column_types(columns):
+    if list(columns).count("l") > 1:
+        raise ValueError("More than one 'label' was specified. "
+                         "Please use -h to get help in providing suitable arguments")
+
+
+class Splitter:
+    '''
+    Splits the rows of a DataFrame into a number of comparable sets.
+
+    columns holds one data type per column of data (l(abel)/c(ategorical)/
+    n(umerical)/a(bsolute)/d(isregard)), as on the command line. A Splitter
+    holds no global state, so one instance can be run as often as needed.
+    '''
+
+    def __init__(self, data, columns, no_sets, max_attempts=20, keep_models=False, warm_start=False, swaps=0,
+                 sample_size=None, silhouette_size=1000, k_select='silhouette', assignment='balanced',
+                 low_memory=False, min_cluster_rows=10):
+        if len(columns) != len(data.columns):
+            raise ValueError("The number of column types (%s) does not match the number of columns "
+                             "in the input (%s)" % (len(columns), len(data.columns)))
+        if no_sets < 2:
+            raise ValueError("Please use more than 1 set for this tool to be meaningful!")
+        if max_attempts < 1:
+            raise ValueError("The number of attempts must be at least 1, not %s" % max_attempts)
+        if sample_size is not None and sample_size < 1:
+            raise ValueError("The sample size must be at least 1, not %s" % sample_size)
+        if k_select not in K_SELECTION and not (isinstance(k_select, int) and k_select > 0):
+            raise ValueError("The number of clusters must be one of %s or a positive number, not '%s'"
+                             % (", ".join(K_SELECTION), k_select))
+        if assignment not in ASSIGNMENTS:
+            raise ValueError("The assignment must be one of %s, not '%s'" % (", ".join(ASSIGNMENTS), assignment))
+
+        self.data = data
+        self.no_sets = no_sets
+        # number of splits to try before giving up on p >= .2 for all variables
+        self.max_attempts = max_attempts
+        # also keep the fitted models of the cluster-count sweep in sweep_cache
+        self.keep_models = keep_models
+        # start the fit for k+1 clusters from the centroids found for k in the sweep
+        self.warm_start = warm_start
+        # number of items the swap optimizer may try to move when an attempt fails (0 turns it off)
+        self.swaps = swaps
+        # large-data mode: fit the clustering of a stratum on this many rows and assign the rest to the
+        # nearest cluster (None fits on all rows)
+        self.sample_size = sample_size
+        # number of rows per stratum the silhouette score of every number of clusters is computed on
+        self.silhouette_size = silhouette_size
+        # how the number of clusters per stratum is chosen (see choose_k)
+        self.k_select = k_select
+        # how the clusters are divided in sets: 'balanced' also balances the features of the sets,
+        # 'greedy' only their sizes
+        self.assignment = assignment
+        # strata with fewer rows are not clustered: all their rows are divided in sets directly, as one cluster
+        self.min_cluster_rows = min_cluster_rows
+        # keep the feature matrix in float32 instead of float64
+        self.low_memory = low_memory
+        # ResultCache to look up and store the result of every run (None: always compute)
+        self.result_cache = None
+        self.categorical_features = []
+        self.continuous_features = []
+        self.absolute_features = []
+        self.label = []
+        self.disregard = []
+
+        for column, feature in zip(data.columns, columns):
+            if feature == "c":
+                self.categorical_features.append(column)
+            elif feature == "n":
+                self.continuous_features.append(column)
+            elif feature == "a":
+                self.absolute_features.append(column)
+            elif feature == "l":
+                self.label.append(column)
+            elif feature == "d":
+                self.disregard.append(column)
+            else:
+                raise ValueError("Unknown data type '%s' for column '%s'" % (feature, column))
+
+        check_column_types(columns)
+        # missing values are only allowed in absolute columns, where they are an instance of their own
+        missing = [column for column in self.categorical_features + self.continuous_features
+                   if data[column].isna().any()]
+        if missing:
+            raise ValueError("Column(s) %s have missing values; only absolute columns can have missing data"
+                             % ", ".join(str(column) for column in missing))
+
+        # everything that stays the same between attempts and runs is prepared only once
+        dtype = np.float32 if low_memory else np.float64
+        self.prepared = prepare(data, self.continuous_features, self.categorical_features, self.label,
+                                self.disregard, self.absolute_features, dtype)
+        self.test_groups = test_groups(data, self.continuous_features, self.categorical_features,
+                                       self.absolute_features)
+
+    def run(self, seed=None, jobs=1, reuse_sweep=False, pool=None):
+        # Try up to max_attempts splits until one has p >= .2 for all variables. Every attempt has its
+        # own seed, so the returned split is the same whether attempts are tried one by one or several
+        # at once on 'jobs' worker processes. pool: a worker_pool of this splitter to use for those, so that
+        # several runs can share one (by default, a pool is started for this run only).
+        # reuse_sweep: the first attempt uses the models fitted by the cluster-count sweep instead of fitting
+        # them again with its own seed. That attempt is then the same for every run, so this is meant for
+        # only one run per data (e.g. the first one); the other runs need their own fits to differ from it.
+        if self.result_cache is not None and seed is not None:
+            result = self.result_cache.get(self, seed, reuse_sweep)
+            if result is not None:
+                log_event('run', seed=seed, attempts=result.iteration + 1, failed=result.significant, cached=True)
+                return result
+        seeds = run_seeds(seed, self.max_attempts)
+        # only the clustering of the strata is done in parallel, so without any stratum to cluster there is
+        # nothing to gain from worker processes
+        if jobs == 1 or not any(self.clustered(stratum) for stratum in self.prepared.strata):
+            for i, attempt_seed in enumerate(seeds):
+                set_numbers, stats, all_ns = self.run_all(attempt_seed, reuse_sweep and i == 0)
+                if all_ns:
+                    break
+            result = SplitResult(set_numbers, stats, i, not all_ns)
+        elif pool is not None:
+            result = schedule_attempts(self, pool, seeds, jobs, reuse_sweep)
+        else:
+            self.prepare_sweeps(jobs)
+            pool = worker_pool(self, jobs)
+            try:
+                result = schedule_attempts(self, pool, seeds, jobs, reuse_sweep)
+            finally:
+                # attempts that are already running cannot be interrupted, but nothing waits for them
+                pool.shutdown(wait=False)
+        log_event('run', seed=seed, attempts=result.iteration + 1, failed=result.significant)
+        if self.result_cache is not None and seed is not None:
+            self.result_cache.put(self, seed, result, reuse_sweep)
+        return result
+
+    def prepare_sweeps(self, jobs=1):
+        # Run the cluster-count sweep of every stratum up front. With several jobs, the fits of all strata
+        # share one pool of 'jobs' processes, largest strata first, and the number of clusters of every
+        # stratum is chosen once its fits are done, in the order of the strata.
+        features = self.prepared.features
+        categorical_idx = self.prepared.categorical_idx
+        cache_keys = {stratum.key: sweep_cache_key(stratum.key, self.sample_size, self.silhouette_size, self.k_select,
+                                                   self.warm_start, self.keep_models)
+                      for stratum in self.prepared.strata}
+        todo = [stratum for stratum in self.prepared.strata
+                if self.clustered(stratum) and cache_keys[stratum.key] not in sweep_cache]
+        if jobs == 1 or len(todo) == 0:
+            for stratum in todo:
+                choose_k(features(stratum), categorical_idx, self.keep_models, 1, self.warm_start, stratum.key,
+                         self.sample_size, self.silhouette_size, self.k_select)
+            return
+
+        largest_first = sorted(todo, key=lambda stratum: stratum.start - stratum.stop)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=set_profile_path, initargs=(profile_path,)) as pool:
+            if self.warm_start:
+                # the fits of one stratum build on each other, so every stratum is one task
+                sweeps = {stratum.key: pool.submit(choose_k, features(stratum), categorical_idx, self.keep_models,
+                                                   1, True, stratum.key, self.sample_size, self.silhouette_size,
+                                                   self.k_select)
+                          for stratum in largest_first}
+                for stratum in todo:
+                    sweep_cache[cache_keys[stratum.key]] = sweeps[stratum.key].result()
+                return
+
+            plans = {}
+            fits = {}
+            for stratum in largest_first:
+                plans[stratum.key] = cl_range, seeds, sample = sweep_plan(features(stratum), stratum.key,
+                                                                          self.sample_size, self.k_select)
+                fits[stratum.key] = [pool.submit(_sweep_fit, features(stratum), k, categorical_idx, seed, None,
+                                                 sample)
+                                     for k, seed in zip(cl_range, seeds)]
+            for stratum in todo:
+                sweep_cache[cache_keys[stratum.key]] = select_k(features(stratum), categorical_idx,
+                                                                plans[stratum.key][0],
+                                                                [fit.result() for fit in fits[stratum.key]],
+                                                                stratum.key, self.keep_models, self.silhouette_size,
+                                                                self.k_select)
+
+    def clustered(self, stratum):
+        # whether the stratum is large enough to be clustered: at least min_cluster_rows, and enough for two
+        # clusters with two items per set each (with fewer, dealing its rows directly balances them as well)
+        return len(stratum.rows) >= max(self.min_cluster_rows, 2 * 2 * self.no_sets)
+
+    def fit_stratum(self, index, seed, reuse_sweep=False):
+        # the clusters of one stratum for one attempt, as arrays of positions in the stratum (with reuse_sweep,
+        # those of the best model of the sweep, without fitting it again)
+        stratum = self.prepared.strata[index]
+        if not self.clustered(stratum):
+            # one cluster: balanced_sets deals its rows from the most extreme to the most central one,
+            # divide_in_sets round-robin
+            return [np.arange(len(stratum.rows))]
+        clusters = clustering(self.prepared.features(stratum), self.prepared.categorical_idx,
+                              None if reuse_sweep else np.random.RandomState(seed), self.keep_models,
+                              warm_start=self.warm_start,
+                              key=stratum.key, sample_size=self.sample_size, silhouette_size=self.silhouette_size,
+                              k_select=self.k_select)
+        return [np.asarray(cluster, dtype=np.intp) for cluster in clusters]
+
+    def run_all(self, seed, reuse_sweep=False):
+        # one attempt: cluster, divide in sets and test the result. Every stratum is clustered with its
+        # own seed, so the strata can also be clustered at the same time (see schedule_attempts).
+        clusters = [self.fit_stratum(i, stratum_seed, reuse_sweep)
+                    for i, stratum_seed in enumerate(run_seeds(seed, len(self.prepared.strata)))]
+        return self.finish_attempt(seed, clusters)
+
+    def divide(self, stratum, clusters, set_sizes):
+        # the set (0-based) of every item of the clusters of one stratum, see balanced_sets and divide_in_sets
+        if self.assignment == 'balanced':
+            return balanced_sets(clusters, set_sizes, self.prepared.features(stratum), self.prepared.categorical_idx)
+        return divide_in_sets(clusters, set_sizes)
+
+    def finish_attempt(self, seed, stratum_clusters):
+        # divide the clusters of every stratum (in the order of the strata) in sets and test the result
+        random_state = np.random.RandomState(seed)
+        set_numbers = np.zeros(len(self.data), dtype=np.intp)
+        set_sizes = np.zeros(self.no_sets, dtype=np.intp)
+        # number of clusters used per stratum, for --profile
+        cluster_counts = {}
+
+        # for each part of the absolute splitting make sets
+        for stratum, clusters in zip(self.prepared.strata, stratum_clusters):
+            cluster_counts[stratum.name] = len(clusters)
+
+            # divide in sets
+            with timed('divide_in_sets', rows=len(stratum.rows), assignment=self.assignment):
+                sets = self.divide(stratum, clusters, set_sizes)
+            items = stratum.rows[np.concatenate(clusters).astype(np.intp)]
+            set_numbers[items] = sets + 1
+
+        # do statistics
+        with timed('statistics'):
+            stats = statistics(self.test_groups, set_numbers, self.continuous_features, self.categorical_features)
+        all_ns = passes(stats)
+
+        # try to repair a failed split by swapping items before giving up on this attempt
+        swapped = False
+        if not all_ns and self.swaps > 0:
+            with timed('optimize', swaps=self.swaps):
+                optimizer = SwapOptimizer(self.test_groups, set_numbers, self.no_sets)
+                set_numbers = optimizer.run(self.swaps, random_state)
+            with timed('statistics'):
+                stats = statistics(self.test_groups, set_numbers, self.continuous_features,
+                                   self.categorical_features)
+            all_ns = passes(stats)
+            swapped = True
+
+        log_event('attempt', seed=seed, k=cluster_counts, passed=all_ns, optimized=swapped)
+
+        set_numbers = pd.Series(set_numbers, index=self.data.index, name='set_number')
+        return set_numbers, stats, all_ns
+
+
+def passes(stats):
+    # the split is good if no test has p < .2
+    all_ns = True
+
+    for var_type in stats:
+        for var in var_type:
+            if var[5] < 0.2:
+                all_ns = False
+    return all_ns
+
+
+def schedule_attempts(splitter, pool, seeds, jobs, reuse_sweep=False):
+    # Keep 'jobs' stratum clusterings running at once: all strata of the first attempt (largest first), then
+    # those of the next attempts. An attempt is divided in sets and tested here as soon as all its strata are
+    # clustered. The first attempt (in seed order) that passes wins, so an attempt that passes early still
+    # waits for the attempts before it, but later ones are cancelled. Strata that are too small to cluster
+    # are not sent to the workers (see Splitter.fit_stratum), so at least one stratum has to be clustered.
+    # reuse_sweep: the first attempt uses the models of the sweep (see Splitter.run).
+    strata = splitter.prepared.strata
+    largest_first = sorted((i for i in range(len(strata)) if splitter.clustered(strata[i])),
+                           key=lambda i: strata[i].start - strata[i].stop)
+    unclustered = {i: splitter.fit_stratum(i, None) for i in range(len(strata)) if not splitter.clustered(strata[i])}
+    stratum_seeds = {}
+    running = {}
+    fitted = {}
+    results = {}
+    next_task = 0
+    first_open = 0
+    # no attempts are started after one that already passed
+    last_attempt = len(seeds)
+    while True:
+        while next_task < last_attempt * len(largest_first) and len(running) < jobs:
+            attempt, index = divmod(next_task, len(largest_first))
+            if attempt not in stratum_seeds:
+                stratum_seeds[attempt] = run_seeds(seeds[attempt], len(strata))
+                fitted[attempt] = dict(unclustered)
+            stratum = largest_first[index]
+            running[pool.submit(_fit_stratum, stratum, stratum_seeds[attempt][stratum],
+                                reuse_sweep and attempt == 0)] = attempt, stratum
+            next_task += 1
+
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            attempt, stratum = running.pop(future)
+            if attempt in results:
+                # another stratum of this attempt already failed
+                continue
+            if future.exception() is not None:
+                results[attempt] = future.exception()
+                continue
+            fitted[attempt][stratum] = future.result()
+            if len(fitted[attempt]) == len(strata):
+                clusters = fitted.pop(attempt)
+                try:
+                    results[attempt] = splitter.finish_attempt(seeds[attempt],
+                                                               [clusters[i] for i in range(len(strata))])
+                except Exception as e:
+                    results[attempt] = e
+                    continue
+                if results[attempt][2]:
+                    last_attempt = min(last_attempt, attempt + 1)
+
+        # errors are only raised once it is their turn, just like in a serial run
+        while first_open in results:
+            outcome = results.pop(first_open)
+            if isinstance(outcome, Exception):
+                for future in running:
+                    future.cancel()
+                raise outcome
+            set_numbers, stats, all_ns = outcome
+            if all_ns or first_open == len(seeds) - 1:
+                for future in running:
+                    future.cancel()
+                return SplitResult(set_numbers, stats, first_open, not all_ns)
+            first_open += 1
+
+
+def write_out(splitter, result, file_name, it_num, source=None):
+    with timed('write_out', run=it_num):
+        _write_out(splitter, result, file_name, it_num, source)
+
+
+def _write_out(splitter, result, file_name, it_num, source=None):
+    # source: the input file, to copy columns from that the splitter did not read (default: write splitter.data)
+    # the tables below use the data and the set numbers as they are, without a copy of the data
+    data = splitter.data
+    set_numbers = result.set_numbers.rename('set_number')
+    categorical_features = splitter.categorical_features
+    continuous_features = splitter.continuous_features
+    absolute_features = splitter.absolute_features
+
     # output file
-    outFileName = fileName + "_out" + str(it_num) + ".csv"
-    inputD.to_csv(outFileName, index=False)
+    outFileName = file_name + "_out" + str(it_num) + ".csv"
+    if source is None:
+        data.assign(set_number=set_numbers).to_csv(outFileName, index=False)
+    else:
+        copy_with_set_numbers(source, set_numbers, outFileName)
     # save statistics to file if there was more than 1 set
-    if no_sets > 1:
-        statFileName = fileName + "_stats" + str(it_num) + ".txt"
+    if splitter.no_sets > 1:
+        stats = result.stats
+        statFileName = file_name + "_stats" + str(it_num) + ".txt"
         f = open(statFileName, "w")
-        iterations = i + 1
+        iterations = result.iteration + 1
         stat_string = (
                 "Number of iterations: %s \n \n"
                 "Results for the following tests:\n" % iterations)
 
-        if significant:
-            stat_string += ("\nIn 20 iterations no split could be found that results in p>.2 for all variables.\n\n")
+        if result.significant:
+            stat_string += ("\nIn %s iterations no split could be found that results in p>.2 for all variables.\n\n"
+                            % splitter.max_attempts)
 
+        lines = []
         for testgroup in stats:
-            for test in testgroup:
-                stat_string += ("Absolute variable instance '%s': " % (
-                stats[stats.index(testgroup)][testgroup.index(test)][0])
-                                + stats[stats.index(testgroup)][testgroup.index(test)][1] + ' for '
-                                + stats[stats.index(testgroup)][testgroup.index(test)][2]
-                                + ": X2(%s) = %s, p = %s" % (stats[stats.index(testgroup)][testgroup.index(test)][4],
-                                                             round(stats[stats.index(testgroup)][testgroup.index(test)][
-                                                                       3], 3),
-                                                             round(stats[stats.index(testgroup)][testgroup.index(test)][
-                                                                       5], 3)) + ";\n")
-
+            for subset, test, feat, statistic, df, p in testgroup:
+                lines.append("Absolute variable instance '%s': %s for %s: X2(%s) = %s, p = %s;\n"
+                             % (subset, test, feat, df, round(statistic, 3), round(p, 3)))
+        stat_string += "".join(lines)
 
         if len(categorical_features) > 0:
             stat_string += ("\nCross-tables for the distribution of categorical features:\n\n")
             for feat in categorical_features:
-                data_crosstab = pd.crosstab(inputD[feat],
-                                            inputD['set_number'], margins=True)
+                data_crosstab = pd.crosstab(data[feat],
+                                            set_numbers, margins=True)
                 stat_string += (data_crosstab.to_string() + "\n\n")
 
-        if len(absolute_features) > 0:
+        if len(absolute_features) == 1:
             stat_string += ("\nCross-table for the distribution of the absolute feature:\n\n")
-            data_crosstab = pd.crosstab(inputD[absolute_features[0]],
-                                        inputD['set_number'], margins=True)
+            data_crosstab = pd.crosstab(data[absolute_features[0]],
+                                        set_numbers, margins=True)
+            stat_string += (data_crosstab.to_string() + "\n\n")
+        elif len(absolute_features) > 1:
+            stat_string += ("\nCross-table for the distribution of the combinations of the absolute features:\n\n")
+            data_crosstab = pd.crosstab([data[feat] for feat in absolute_features],
+                                        set_numbers, margins=True)
             stat_string += (data_crosstab.to_string() + "\n\n")
 
         if len(continuous_features) > 0:
             stat_string += ("\nAverage values per set:\n\n")
             for feat in continuous_features:
-                for set in range(1,no_sets+1):
-                    mean = inputD.loc[inputD['set_number']== set , feat].mean()
+                for set in range(1, splitter.no_sets+1):
+                    mean = data.loc[set_numbers == set, feat].mean()
                     stat_string += (feat + " in set " + str(set) +": " + str(mean) + "\n")
 
         f.write(stat_string)
         f.close()
 
 
+STATS_COLUMNS = ['run', 'attempts', 'failed', 'subset', 'test', 'feature', 'statistic', 'df', 'p']
 
-def run_all(i, it_num):
-    output_sets = []
-    for single_set in range(0, no_sets):
-        output_sets.append([])
 
-    if no_sets > 1:
-        # prepare data
-        dat = prepare_data(inputD, continuous_features, categorical_features, label, disregard)
+def stats_table(result, it_num):
+    # the tests of one run as rows of a table, one row per test
+    rows = [[it_num, result.iteration + 1, result.significant] + list(test)
+            for testgroup in result.stats for test in testgroup]
+    return pd.DataFrame(rows, columns=STATS_COLUMNS)
 
-        # split by "absolute" feature and remove absolute features from clustering
-        if len(absolute_features) == 1:
-            datasets = split(absolute_features[0], dat)
+
+class OutputWriter:
+    '''
+    Writes the results of a number of runs on a background thread, so that
+    writing one run overlaps with computing the next.
+
+    By default every run gets its own output and stats file (see write_out).
+    With combine set to 'csv' or 'parquet', the input is written only once,
+    to <file_name>_out.csv/.parquet, with one set number column per run, and
+    the tests of all runs go to a single table, <file_name>_stats.csv.
+    '''
+
+    def __init__(self, splitter, file_name, source=None, combine=None):
+        self.splitter = splitter
+        self.file_name = file_name
+        self.source = source
+        self.combine = combine
+        self.thread = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        # combined mode: set numbers per run, stored compactly, and stats of runs that are not written yet
+        self.set_columns = {}
+        self.finished = {}
+        self.next_run = 0
+
+    def add(self, it_num, result):
+        if self.combine is None:
+            self.pending.append(self.thread.submit(write_out, self.splitter, result, self.file_name, it_num,
+                                                   self.source))
         else:
-            datasets = [dat]
-    else:
-        print("Please use more than 1 set for this tool to be meaningful!")
-        sys.exit(1)  # abort
+            self.set_columns[it_num] = np.asarray(result.set_numbers, dtype=np.min_scalar_type(self.splitter.no_sets))
+            self.pending.append(self.thread.submit(self._append_stats, it_num, result))
+        # report a failed write as soon as possible instead of after the last run
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            future.result()
 
-    # for each part of the absolute splitting make sets
-    for data in datasets:
-        # form clusters
-        clusters = clustering(data, categorical_features, continuous_features)
+    def _append_stats(self, it_num, result):
+        # runs can finish in any order, but are written in run order so that the file is always the same
+        self.finished[it_num] = stats_table(result, it_num)
+        while self.next_run in self.finished:
+            self.finished.pop(self.next_run).to_csv(self.file_name + "_stats.csv", index=False,
+                                                   mode='w' if self.next_run == 0 else 'a',
+                                                   header=self.next_run == 0)
+            self.next_run += 1
 
-        # divide in sets
-        divide_in_sets(clusters, output_sets)
+    def _timed_write_sets(self):
+        with timed('write_out', runs=len(self.set_columns)):
+            self._write_sets()
 
-    set_numbers = []
-    for item in inputD.index:
-        for j in range(len(output_sets)):
-            if item in output_sets[j]:
-                set_numbers.append(j + 1)
+    def _write_sets(self):
+        set_numbers = pd.DataFrame({'set_number_%s' % it_num: self.set_columns[it_num]
+                                    for it_num in sorted(self.set_columns)}, index=self.splitter.data.index)
+        out_file_name = self.file_name + "_out." + self.combine
+        if self.combine == 'csv' and self.source is not None:
+            copy_with_set_numbers(self.source, set_numbers, out_file_name)
+            return
+        if self.source is None:
+            data = self.splitter.data
+        elif pathlib.Path(self.source).suffix.lower() in COLUMNAR_SUFFIXES:
+            data = read_columnar(self.source)
+        else:
+            data = pd.read_csv(self.source)
+        output = pd.concat([data.reset_index(drop=True), set_numbers.reset_index(drop=True)], axis=1)
+        if self.combine == 'csv':
+            output.to_csv(out_file_name, index=False)
+        else:
+            output.to_parquet(out_file_name, index=False)
 
-    # add new column
-    inputD['set_number'] = set_numbers
+    def close(self):
+        try:
+            if self.combine is not None and self.set_columns:
+                self.pending.append(self.thread.submit(self._timed_write_sets))
+            for future in self.pending:
+                future.result()
+        finally:
+            self.thread.shutdown()
 
-    # do statistics
-    stats = statistics(inputD)
+    def __enter__(self):
+        return self
 
-    # This checks for looping but is inside the loop
-    all_ns = True
+    def __exit__(self, *exc_info):
+        self.close()
 
-    for var_type in stats:
-        for var in var_type:
-            if var[5] < 0.2:
-                all_ns = False
 
-    # write to files
-    if all_ns:
-        write_out(stats, i, False, it_num)
-    elif i < 19:
-        i = i + 1
-        run_all(i, it_num)
-    else:
-        print("failed")
-        write_out(stats, i, True, it_num)
+class ResultCache:
+    '''
+    Keeps the result of every run on disk, so that running the same command
+    again only has to write the output files. A run is looked up by the
+    input (a hash of the file and the column types), all settings that
+    change the split and the seed of the run. Every result is one small
+    compressed .npz file in directory; once they take more than max_bytes,
+    the least recently used ones are removed.
+    '''
 
+    # part of every key: change it when a change to the code gives other splits for the same settings
+    VERSION = 2
 
-### actually run the program ###
+    def __init__(self, directory, input_key, max_bytes=512 * 2 ** 20):
+        self.directory = pathlib.Path(directory)
+        self.input_key = input_key
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
 
-for it_num in range(iterations):
-    # progress bar
-    perc = 20//iterations
+    def path(self, splitter, seed, reuse_sweep=False):
+        key = hashlib.sha1(repr((self.VERSION, self.input_key, splitter.no_sets, splitter.max_attempts,
+                                 splitter.swaps, splitter.sample_size, splitter.silhouette_size, splitter.k_select,
+                                 splitter.assignment, splitter.warm_start, splitter.low_memory,
+                                 splitter.min_cluster_rows, seed, reuse_sweep)).encode())
+        return self.directory / (key.hexdigest() + '.npz')
+
+    def get(self, splitter, seed, reuse_sweep=False):
+        # the cached SplitResult of this run, or None
+        path = self.path(splitter, seed, reuse_sweep)
+        try:
+            with np.load(path) as stored:
+                sets, values, header = stored['sets'], stored['values'], json.loads(str(stored['header']))
+            # mark as recently used
+            os.utime(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # not cached (or a damaged file, which is overwritten once the run is done again)
+            return None
+        stats = []
+        row = 0
+        for names in header['tests']:
+            stats.append([])
+            for subset, test, feature in names:
+                stats[-1].append([subset, test, feature, values[row, 0], int(values[row, 1]), values[row, 2]])
+                row += 1
+        set_numbers = pd.Series(sets.astype(np.intp), index=splitter.data.index, name='set_number')
+        return SplitResult(set_numbers, stats, header['iteration'], header['significant'])
+
+    def put(self, splitter, seed, result, reuse_sweep=False):
+        header = {'iteration': int(result.iteration), 'significant': bool(result.significant),
+                  'tests': [[[plain(subset), test, plain(feature)] for subset, test, feature, *_ in testgroup]
+                            for testgroup in result.stats]}
+        values = np.array([test[3:6] for testgroup in result.stats for test in testgroup],
+                          dtype=np.float64).reshape(-1, 3)
+        path = self.path(splitter, seed, reuse_sweep)
+        # written under another name first, so other processes never read half a file
+        temporary = path.with_suffix('.%s.tmp' % os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, sets=np.asarray(result.set_numbers, dtype=np.min_scalar_type(splitter.no_sets)),
+                                values=values, header=np.array(json.dumps(header, default=str)))
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob('*.npz'):
+            try:
+                entries.append((path.stat().st_mtime, path.stat().st_size, path))
+            except OSError:
+                # removed by another process in the meantime
+                pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+
+def plain(value):
+    # numpy numbers (e.g. the name of an absolute variable instance) as plain Python values, for JSON
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def file_digest(path, columns, block_size=2 ** 20):
+    # hash of the bytes of a file and the column types used to split it
+    digest = hashlib.sha1(repr(list(columns)).encode())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_seeds(seed, runs):
+    # one independent, reproducible seed per run, derived from a single base seed
+    return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(runs)]
+
+
+# set once per worker process, so the input data is only sent to each worker once
+_worker_splitter = None
+
+
+def _init_worker(splitter, sweeps, profile=None):
+    global _worker_splitter
+    _worker_splitter = splitter
+    sweep_cache.update(sweeps)
+    set_profile_path(profile)
+    # runs are already spread over the cores, so keep numpy/sklearn from starting threads of their own
+    threadpool_limits(1)
+
+
+def worker_pool(splitter, jobs):
+    # workers start with the sweeps that are already known, so they do not repeat them
+    return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                               initargs=(splitter, sweep_cache, profile_path))
+
+
+def _fit_stratum(index, seed, reuse_sweep=False):
+    return _worker_splitter.fit_stratum(index, seed, reuse_sweep)
+
+
+def _run(it_num, seed):
+    return it_num, _worker_splitter.run(seed, reuse_sweep=it_num == 0)
+
+
+def _run_and_write(file_name, it_num, seed, source=None):
+    result = _worker_splitter.run(seed, reuse_sweep=it_num == 0)
+    write_out(_worker_splitter, result, file_name, it_num, source)
+    return it_num, result.significant
+
+
+def run_jobs(splitter, file_name, seeds, jobs=1, source=None, combine=None):
+    # Generate one output option per seed and write it to disk, using up to 'jobs' processes. With
+    # fewer runs than jobs, the processes are used to try several attempts of each run at once instead.
+    # combine: None for separate files per run, or 'csv'/'parquet' for one file (see OutputWriter)
+    with OutputWriter(splitter, file_name, source, combine) as writer:
+        # runs in the result cache only have to be written, without starting any workers for them
+        todo = []
+        finished = 0
+        for it_num, seed in enumerate(seeds):
+            result = splitter.result_cache.get(splitter, seed, it_num == 0) if splitter.result_cache is not None \
+                else None
+            if result is None:
+                todo.append((it_num, seed))
+                continue
+            log_event('run', seed=seed, attempts=result.iteration + 1, failed=result.significant, cached=True)
+            writer.add(it_num, result)
+            finished += 1
+            progress(finished, len(seeds), result.significant)
+        if len(todo) == 0:
+            return
+        if jobs == 1:
+            for it_num, seed in todo:
+                result = splitter.run(seed, reuse_sweep=it_num == 0)
+                writer.add(it_num, result)
+                finished += 1
+                progress(finished, len(seeds), result.significant)
+            return
+        splitter.prepare_sweeps(jobs)
+        # one pool for all runs, so the splitter is only sent to the workers once, and attempts that are
+        # still running when their run is done take up a worker instead of an extra core
+        with worker_pool(splitter, jobs) as pool:
+            if len(todo) < jobs:
+                for it_num, seed in todo:
+                    result = splitter.run(seed, jobs, it_num == 0, pool)
+                    writer.add(it_num, result)
+                    finished += 1
+                    progress(finished, len(seeds), result.significant)
+            else:
+                # separate files are written by the workers themselves, combined output by this process
+                if combine is None:
+                    futures = [pool.submit(_run_and_write, file_name, it_num, seed, source) for it_num, seed in todo]
+                else:
+                    futures = [pool.submit(_run, it_num, seed) for it_num, seed in todo]
+                for future in as_completed(futures):
+                    if combine is None:
+                        it_num, significant = future.result()
+                    else:
+                        it_num, result = future.result()
+                        writer.add(it_num, result)
+                        significant = result.significant
+                    finished += 1
+                    progress(finished, len(seeds), significant)
+
+
+def progress(finished, total, significant=False):
+    if significant:
+        print("failed")
     sys.stdout.write('\r')
-    sys.stdout.write("[%-20s] %d%%" % ('=' * it_num * perc, it_num / iterations * 100))
+    sys.stdout.write("[%-20s] %d%%" % ('=' * (20 * finished // total), finished / total * 100))
     sys.stdout.flush()
 
-    # initiate loop-tracking
-    i = 0
-    # start first loop
-    run_all(i, it_num)
 
-# final progress bar
-sys.stdout.write('\r')
-sys.stdout.write("[%-20s] %d%%" % ('=' * 20, 100))
-sys.stdout.flush()
+def k_selection(value):
+    # --k-select takes the name of a strategy or a number of clusters
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    if value not in K_SELECTION:
+        raise argparse.ArgumentTypeError("choose from %s or a positive number" % ", ".join(K_SELECTION))
+    return value
+
+
+def positive_number(value):
+    # options that need at least 1
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError("must be a positive number, not '%s'" % value)
+    return int(value)
+
+
+def parse_arguments(argv=None):
+    # check whether path and number of sets arguments were provided
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datapath', type=pathlib.Path,
+                        help='path to input data file (csv, or parquet/feather/arrow if pyarrow is installed)')
+    parser.add_argument('sets', type=int, help='provide number of desired sets')
+    parser.add_argument('--columns', nargs='*',
+                        choices=list(COLUMN_TYPES),
+                        help='provide the data type for each column (l(abel)/c(ategorical)'
+                             '/n(umerical)/a(bsolute)/d(isregard).'
+                             'The number of labels needs to match the number of columns'
+                             ' in your input file. If this is not the case you can provide '
+                             'them later on and your input will be ignored.'
+                             '"Label" can only be specified once. With several "absolute" columns, the '
+                             'sets are balanced within every combination of their values.',
+                        default=None)
+    parser.add_argument('--runs', type=positive_number,
+                        help='indicate how many different output options you want to generate',
+                        default=1)
+    parser.add_argument('--jobs', type=int,
+                        help='number of runs to compute at the same time (0 uses all cores)',
+                        default=1)
+    parser.add_argument('--attempts', type=positive_number,
+                        help='maximum number of tries to find a split with p >= .2 for all variables',
+                        default=20)
+    parser.add_argument('--warm-start', action='store_true',
+                        help='start each fit of the cluster-count sweep from the centroids of the previous one')
+    parser.add_argument('--optimize', type=int, metavar='SWAPS',
+                        help='when a split fails, try to fix it by swapping up to this many items between '
+                             'sets (within the same absolute variable instance) before trying a new split',
+                        default=0)
+    parser.add_argument('--sample-size', type=positive_number,
+                        help='for very large inputs: fit the clustering on a random sample of this many items per '
+                             'absolute variable instance (k-means uses mini-batches of this size) and assign all '
+                             'other items to the nearest cluster',
+                        default=None)
+    parser.add_argument('--k-select', type=k_selection, metavar='{%s,K}' % ','.join(K_SELECTION),
+                        help='how to choose the number of clusters: the best silhouette score, the elbow of the '
+                             'clustering cost (no silhouette scores), k = sqrt(items / 2) (only one fit) or a '
+                             'fixed number K (only one fit)',
+                        default='silhouette')
+    parser.add_argument('--assign', choices=ASSIGNMENTS,
+                        help='how to divide the clusters in sets: also balance the numerical features and '
+                             'categories of the sets (most splits pass at the first attempt) or only their sizes '
+                             '(as earlier versions did)',
+                        default='balanced')
+    parser.add_argument('--min-cluster-rows', type=int, metavar='ROWS',
+                        help='absolute variable instances with fewer items (or fewer than four per set) are not '
+                             'clustered, their items are divided in sets directly (sorted by their features, or '
+                             'round-robin with --assign greedy)',
+                        default=10)
+    parser.add_argument('--silhouette-size', type=int,
+                        help='number of items per absolute variable instance the silhouette score of every '
+                             'number of clusters is computed on (0 uses all items; memory grows with its square)',
+                        default=1000)
+    parser.add_argument('--low-memory', action='store_true',
+                        help='for very large inputs: keep the features used for clustering in single precision '
+                             '(half the memory; the clustering may differ slightly) and report the peak memory use')
+    parser.add_argument('--chunksize', type=int,
+                        help='read the csv file this many rows at a time, to keep memory use down for large files',
+                        default=None)
+    parser.add_argument('--combine', nargs='?', const='csv', choices=['csv', 'parquet'],
+                        help='write the input only once, with one set number column per run (as csv, or as '
+                             'parquet if pyarrow is installed), and the tests of all runs to one stats table',
+                        default=None)
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep the result of every run in this directory, so that running the same command '
+                             '(with the same --seed) again only writes the output files',
+                        default=None)
+    parser.add_argument('--cache-size', type=int, metavar='MB',
+                        help='remove the least recently used results once the cache takes more than this',
+                        default=512)
+    parser.add_argument('--profile', metavar='FILE',
+                        help='append timings per phase, attempts per run, the chosen number of clusters and '
+                             'peak memory to this file, as one JSON object per line',
+                        default=None)
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='write cProfile statistics of the main process to this file (see pstats)',
+                        default=None)
+    parser.add_argument('--seed', type=int,
+                        help='base seed for the random number generators; the same seed and number of '
+                             'runs always give the same output files',
+                        default=None)
+    return parser.parse_args(argv)
+
+
+COLUMNAR_SUFFIXES = ('.parquet', '.feather', '.arrow')
+
+
+def read_input(datapath, usecols=None, types=None, chunksize=None, nrows=None):
+    # Read file and check if it's suitable. Only the columns in usecols are read (all if None) and, if the
+    # column types are known, stored compactly. CSV files can be read chunksize rows at a time, Parquet
+    # and Arrow/Feather files (needs pyarrow) are read column by column. nrows=0 only reads the header.
+    # noinspection PyBroadException
+    try:
+        if pathlib.Path(datapath).suffix.lower() in COLUMNAR_SUFFIXES:
+            data = read_columnar(datapath, usecols, nrows)
+        elif chunksize is None or nrows is not None:
+            data = pd.read_csv(datapath, usecols=usecols, nrows=nrows)
+        else:
+            # categorical and absolute columns are read as text, as the type pandas would guess could differ
+            # between chunks (e.g. text in one chunk and only digits in the next)
+            text = [column for column, feature in (types or {}).items() if feature in ('c', 'a')]
+            chunks = [compact_dtypes(chunk, types or {})
+                      for chunk in pd.read_csv(datapath, usecols=usecols, chunksize=chunksize,
+                                               dtype=dict.fromkeys(text, str))]
+            data = numeric_text(concat_chunks(chunks), text)
+        # usecols does not keep the order in which the columns were asked for
+        if usecols is not None:
+            data = data[list(usecols)]
+        return compact_dtypes(data, types or {})
+    except FileNotFoundError:
+        print("File not found.")
+    except ImportError:
+        print("Reading Parquet or Arrow files needs the pyarrow package.")
+    except pd.errors.EmptyDataError:
+        print("No data")
+    except pd.errors.ParserError:
+        print("Parse error")
+    except Exception:
+        print("Something else went wrong. \n "
+              "Make sure your input looks as follows: \n"
+              "'model.py [path to csv file] [number of sets].'")
+    sys.exit(1)  # abort
+
+
+def read_columnar(datapath, usecols=None, nrows=None):
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    if pathlib.Path(datapath).suffix.lower() == '.parquet':
+        if nrows == 0:
+            return pd.DataFrame(columns=pyarrow.parquet.read_schema(datapath).names)
+        return pd.read_parquet(datapath, columns=usecols)
+    if nrows == 0:
+        with pyarrow.ipc.open_file(datapath) as reader:
+            return pd.DataFrame(columns=reader.schema.names)
+    return pd.read_feather(datapath, columns=usecols)
+
+
+def compact_dtypes(data, types):
+    # lossless smaller storage, based on the column types: text in categorical and absolute columns
+    # becomes a pandas categorical and integer columns get the smallest integer type that fits
+    for column in data.columns:
+        if types.get(column) in ('c', 'a') and not pd.api.types.is_numeric_dtype(data[column]) \
+                and not isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype('category')
+        elif types.get(column) in ('c', 'a', 'n') and pd.api.types.is_integer_dtype(data[column]):
+            data[column] = pd.to_numeric(data[column], downcast='integer')
+    return data
+
+
+def concat_chunks(chunks):
+    # categoricals of different chunks have different categories, so they are combined first (with their
+    # categories sorted, as when the whole file is read at once)
+    combined = {}
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            combined[column] = pd.Series(union_categoricals([chunk[column] for chunk in chunks],
+                                                            sort_categories=True), name=column)
+    data = pd.concat([chunk.drop(columns=list(combined)) for chunk in chunks], ignore_index=True)
+    for column, values in combined.items():
+        data[column] = values
+    return data[list(chunks[0].columns)]
+
+
+def numeric_text(data, columns):
+    # columns (read as text) that only hold numbers become numbers, as when the whole file is read at once
+    for column in columns:
+        values = data[column]
+        categories = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else values.dropna()
+        if len(categories) > 0 and pd.to_numeric(categories, errors='coerce').notna().all():
+            data[column] = pd.to_numeric(values.astype(object))
+    return data
+
+
+def copy_with_set_numbers(datapath, set_numbers, out_file_name, chunksize=100000):
+    # write the input file (all of its columns, values exactly as they are in the file) with the set
+    # numbers added, without keeping the whole file in memory. set_numbers is a Series, or a DataFrame
+    # with one column of set numbers per run.
+    set_numbers = pd.DataFrame(set_numbers)
+    if pathlib.Path(datapath).suffix.lower() in COLUMNAR_SUFFIXES:
+        chunks = [read_columnar(datapath)]
+    else:
+        chunks = pd.read_csv(datapath, dtype=str, keep_default_na=False, chunksize=chunksize)
+    start = 0
+    for chunk in chunks:
+        for column, values in set_numbers.items():
+            chunk[column] = values.to_numpy()[start:start + len(chunk)]
+        chunk.to_csv(out_file_name, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+        start += len(chunk)
+
+
+def ask_column_types(columns):
+    # Check all the columns and ask about status. Label can only be chosen once.
+    print("You didn't provide valid data type indications when running the program. Please specify them now")
+    types = []
+    for column in columns:
+        feature = None
+        while feature is None:
+            input_value = input("Is '" + column + "' the label (can only be assigned once), a categorical, "
+                                                  "numerical or absolute variable "
+                                                  "or should it be disregarded in splitting? l/c/n/a/d ")
+            if input_value not in COLUMN_TYPES:
+                print("Please choose either l, c, n, a or d ")
+            else:
+                feature = input_value
+                if feature == "l" and "l" in types:
+                    print('You already have a label. Please choose something else.')
+                    feature = None
+        types.append(feature)
+    return types
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    set_profile_path(args.profile)
+    wall, cpu = time.perf_counter(), time.process_time()
+    if args.cprofile is None:
+        split_file(args)
+    else:
+        # only this process is profiled; the work of --jobs worker processes does not show up
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(split_file, args)
+        finally:
+            profiler.dump_stats(args.cprofile)
+    peak, peak_children = peak_memory()
+    if args.low_memory and peak is not None:
+        workers = " (largest worker process: %.0f MB)" % peak_children if args.jobs != 1 else ""
+        print("\nPeak memory use: %.0f MB%s" % (peak, workers))
+    log_event('summary', runs=args.runs, wall=time.perf_counter() - wall, cpu=time.process_time() - cpu,
+              peak_memory_mb=peak, peak_memory_children_mb=peak_children)
+
+
+def split_file(args):
+    # only the header is needed to know which columns to read
+    header = list(read_input(args.datapath, nrows=0).columns)
+    fileName = pathlib.Path(args.datapath).with_suffix('').name
+    # number of runs provided as an argument. If nothing is provided it's 1. Also needs to come from GUI!
+    iterations = args.runs
+
+    # The following info must come from user. In GUI this should be selected in the GUI after opening a file!
+    if args.columns is None or len(args.columns) != len(header):
+        columns = ask_column_types(header)
+    # if specified when running program, take them from there
+    else:
+        columns = args.columns
+
+    try:
+        check_column_types(columns)
+        # labels and disregarded columns are not needed for splitting; they are copied from the file
+        # when the output is written
+        types = {column: feature for column, feature in zip(header, columns) if feature not in ('l', 'd')}
+        inputD = read_input(args.datapath, list(types), types, args.chunksize)
+        splitter = Splitter(inputD, list(types.values()), args.sets, args.attempts, warm_start=args.warm_start,
+                            swaps=args.optimize, sample_size=args.sample_size,
+                            silhouette_size=args.silhouette_size or None, k_select=args.k_select,
+                            assignment=args.assign, low_memory=args.low_memory,
+                            min_cluster_rows=args.min_cluster_rows)
+        # without a seed every run gets new seeds, so its results would never be found again
+        if args.cache is not None and args.seed is not None:
+            splitter.result_cache = ResultCache(args.cache, file_digest(args.datapath, columns),
+                                                args.cache_size * 2 ** 20)
+    except (ValueError, OSError) as e:
+        print(e)
+        sys.exit(1)  # abort
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    # progress bar
+    progress(0, iterations)
+    run_jobs(splitter, fileName, run_seeds(args.seed, iterations), jobs, args.datapath, args.combine)
+
 
-# initiate loop-tracking
-#i = 0
-# start first loop
-#run_all(i)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+# Copyright 2022 Dörte de Kok
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A long-running local split service that keeps the libraries loaded and caches prepared data, plus a
+# small client for it, e.g.:
+#   python3 service.py serve --port 8765
+#   python3 service.py split test-files/input.csv 3 --columns l a n c n c --runs 2 --port 8765
+#
+# POST /split takes a JSON object with the data as csv text ("csv"), "columns" and "sets", and optionally
+# "runs", "seed", "attempts", "optimize", "sample_size", "k_select", "assign" and "min_cluster_rows" (as for
+# model.py). The answer is streamed as JSON lines: one per run, as soon as the run is done, then a last line
+# with "done". GET /health tells whether the service is up.
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import math
+import os
+import socket
+import sys
+import threading
+import time
+
+# the model (and with it pandas, scikit-learn and kmodes) is only loaded by the service, not by the client
+model = None
+batch = None
+pd = None
+
+
+class LRUCache:
+    # at most 'size' entries, the least recently used one is dropped first
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, make):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = make()
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+
+class SplitService:
+    '''
+    Answers split requests from data that is kept between requests: the
+    parsed data per content hash, a Splitter (with its prepared features and
+    test groups) per data and settings, and the number of clusters per
+    stratum (model.sweep_cache).
+    '''
+
+    def __init__(self, max_datasets=16, max_splitters=32, max_sweeps=1024):
+        self.datasets = LRUCache(max_datasets)
+        self.splitters = LRUCache(max_splitters)
+        self.max_sweeps = max_sweeps
+        # the model has global caches and the runs use all of a core, so one split is done at a time
+        self.lock = threading.Lock()
+
+    def splitter(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("The request must be a JSON object")
+        if not isinstance(request.get('csv'), str):
+            raise ValueError("The request needs the data as csv text in 'csv'")
+        unknown = set(request) - {'csv', 'columns', 'sets', 'runs', 'seed', 'attempts', 'optimize', 'sample_size',
+                                  'k_select', 'assign', 'min_cluster_rows'}
+        if unknown:
+            raise ValueError("Unknown field(s) %s" % ", ".join(sorted(unknown)))
+        columns = request.get('columns')
+        if isinstance(columns, str):
+            columns = columns.split()
+        try:
+            k_select = model.k_selection(str(request.get('k_select', 'silhouette')))
+        except argparse.ArgumentTypeError as e:
+            raise ValueError("k_select: %s" % e)
+        job = batch.Job('the data', int(request.get('sets', 0)), list(columns or []),
+                        attempts=int(request.get('attempts', 20)), optimize=int(request.get('optimize', 0)),
+                        sample_size=None if request.get('sample_size') is None else int(request['sample_size']),
+                        k_select=k_select,
+                        assign=str(request.get('assign', 'balanced')),
+                        min_cluster_rows=int(request.get('min_cluster_rows', 10)))
+        content = hashlib.sha1(request['csv'].encode()).hexdigest()
+        data = self.datasets.get(content, lambda: pd.read_csv(io.StringIO(request['csv'])))
+        key = (content, tuple(job.columns), job.sets, job.attempts, job.optimize, job.sample_size, job.k_select,
+               job.assign, job.min_cluster_rows)
+        return self.splitters.get(key, lambda: batch.make_splitter(job, data))
+
+    def split(self, request):
+        # the events of one request: one per run, then 'done' (or 'error' if a run failed)
+        start = time.perf_counter()
+        with self.lock:
+            splitter = self.splitter(request)
+            seeds = model.run_seeds(request.get('seed'), int(request.get('runs', 1)))
+            yield {'event': 'start', 'runs': len(seeds), 'rows': len(splitter.data)}
+            for it_num, seed in enumerate(seeds):
+                try:
+                    result = splitter.run(seed, reuse_sweep=it_num == 0)
+                except Exception as e:
+                    yield {'event': 'error', 'error': str(e)}
+                    return
+                yield {'event': 'run', 'run': it_num, 'attempts': result.iteration + 1, 'failed': result.significant,
+                       'set_numbers': result.set_numbers.tolist(),
+                       'stats': [[json_value(value) for value in test] for testgroup in result.stats
+                                 for test in testgroup]}
+            # keep the sweeps of the most recently added strata
+            for key in list(model.sweep_cache)[:max(len(model.sweep_cache) - self.max_sweeps, 0)]:
+                del model.sweep_cache[key]
+        yield {'event': 'done', 'seconds': time.perf_counter() - start}
+
+
+def json_value(value):
+    # numpy numbers as plain numbers, and NaN (no test result) as null, which JSON has no number for
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class SplitHandler(BaseHTTPRequestHandler):
+    # chunked transfer encoding, so every run is sent as soon as it is done
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, {'status': 'ok', 'datasets': len(self.server.service.datasets.entries),
+                             'splitters': len(self.server.service.splitters.entries)})
+
+    def do_POST(self):
+        if self.path != '/split':
+            return self.send_json(404, {'error': 'Not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            events = self.server.service.split(request)
+            # errors in the request show up before anything is sent
+            first = next(events)
+        except (ValueError, TypeError, KeyError) as e:
+            return self.send_json(400, {'error': str(e)})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            self.send_chunk(first)
+            for event in events:
+                self.send_chunk(event)
+            self.wfile.write(b'0\r\n\r\n')
+        finally:
+            # also if the client went away: stops the runs and frees the service for the next request
+            events.close()
+
+    def send_chunk(self, event):
+        line = (json.dumps(event) + '\n').encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+    def send_json(self, code, body):
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        # clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(port=8765, unix_socket=None, host='127.0.0.1'):
+    global model, batch, pd
+    import model
+    import batch
+    import pandas as pd
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, SplitHandler)
+        where = unix_socket
+    else:
+        server = ThreadingHTTPServer((host, port), SplitHandler)
+        where = 'http://%s:%s' % (host, server.server_address[1])
+    server.service = SplitService()
+    print("Split service listening on %s" % where)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket is not None:
+            os.remove(unix_socket)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    # HTTP over a unix socket
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request_split(csv_text, columns, sets, port=8765, unix_socket=None, host='127.0.0.1', **options):
+    # Send a split request to a running service and yield its answer, one event (dict) at a time.
+    # options: runs, seed, attempts, optimize, sample_size, k_select, assign, min_cluster_rows
+    if unix_socket is not None:
+        connection = UnixHTTPConnection(unix_socket)
+    else:
+        connection = http.client.HTTPConnection(host, port)
+    body = dict(options, csv=csv_text, columns=list(columns), sets=sets)
+    try:
+        connection.request('POST', '/split', json.dumps(body), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        if response.status != 200:
+            raise ValueError(json.loads(response.read()).get('error'))
+        for line in response:
+            yield json.loads(line)
+    finally:
+        connection.close()
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='local split service and its client')
+    commands = parser.add_subparsers(dest='command', required=True)
+    server = commands.add_parser('serve', help='start the service')
+    client = commands.add_parser('split', help='send a csv file to the service and print the answer as JSON lines')
+    client.add_argument('datapath', help='path to input csv file')
+    client.add_argument('sets', type=int, help='provide number of desired sets')
+    client.add_argument('--columns', nargs='+', required=True, help='data type per column, as for model.py')
+    client.add_argument('--runs', type=int, default=1)
+    client.add_argument('--seed', type=int, default=None)
+    client.add_argument('--attempts', type=int, default=20)
+    client.add_argument('--optimize', type=int, default=0)
+    client.add_argument('--k-select', default='silhouette')
+    client.add_argument('--assign', default='balanced')
+    client.add_argument('--min-cluster-rows', type=int, default=10)
+    for sub in (server, client):
+        sub.add_argument('--port', type=int, default=8765, help='port on localhost')
+        sub.add_argument('--socket', default=None, help='use this unix socket instead of a port')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.command == 'serve':
+        serve(args.port, args.socket)
+        return
+    with open(args.datapath) as f:
+        csv_text = f.read()
+    try:
+        for event in request_split(csv_text, args.columns, args.sets, args.port, args.socket, runs=args.runs,
+                                   seed=args.seed, attempts=args.attempts, optimize=args.optimize,
+                                   k_select=args.k_select, assign=args.assign,
+                                   min_cluster_rows=args.min_cluster_rows):
+            print(json.dumps(event))
+            sys.stdout.flush()
+    except (OSError, ValueError) as e:
+        print("Split failed: %s" % e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+import batch
+
+
+def write_manifest(path, **fields):
+    job = dict(file='input.csv', sets=3, columns='l a n c n c', **fields)
+    path.write_text(json.dumps([job]))
+    return path
+
+
+def test_manifest_fields_are_converted(tmp_path):
+    job, = batch.read_manifest(write_manifest(tmp_path / 'jobs.json', runs='2', k_select='3'))
+    assert (job.runs, job.k_select, job.columns) == (2, 3, ['l', 'a', 'n', 'c', 'n', 'c'])
+
+
+@pytest.mark.parametrize('fields', [dict(k_select='bogus'), dict(runs='many'), dict(combine='xlsx'),
+                                    dict(assign='random'), dict(colour='red')])
+def test_invalid_manifest_fields_are_value_errors(tmp_path, fields):
+    # batch.py reports these as "Could not read the manifest"
+    with pytest.raises(ValueError, match='Job 1'):
+        batch.read_manifest(write_manifest(tmp_path / 'jobs.json', **fields))
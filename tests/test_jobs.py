@@ -0,0 +1,27 @@
+import pathlib
+
+import pandas as pd
+import pytest
+
+import model
+
+INPUT = pathlib.Path(__file__).resolve().parent.parent / 'test-files' / 'input.csv'
+TYPES = {'correct': 'a', 'freq': 'n', 'wordclass': 'c', 'image': 'n', 'testCat': 'c'}
+
+
+def write_runs(directory, runs, jobs, monkeypatch):
+    # the output files of model.py input.csv 3 --columns l a n c n c --runs [runs] --seed 5 --jobs [jobs]
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    splitter = model.Splitter(pd.read_csv(INPUT)[list(TYPES)], list(TYPES.values()), 3)
+    model.run_jobs(splitter, 'input', model.run_seeds(5, runs), jobs, INPUT)
+    return {path.name: path.read_bytes() for path in directory.iterdir()}
+
+
+# fewer runs than jobs share the jobs between the attempts of a run, more runs are spread over the jobs
+@pytest.mark.parametrize('runs', [1, 3])
+def test_jobs_give_the_same_files_as_a_serial_run(tmp_path, monkeypatch, runs):
+    serial = write_runs(tmp_path / 'serial', runs, 1, monkeypatch)
+    parallel = write_runs(tmp_path / 'parallel', runs, 2, monkeypatch)
+    assert len(serial) == 2 * runs
+    assert parallel == serial
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import model
+
+CONTINUOUS = ['freq', 'image']
+CATEGORICAL = ['wordclass', 'single']
+
+
+def make_data(rng, n=90):
+    return pd.DataFrame({'stratum': np.repeat(['x', 'y', 'z'], n // 3),
+                         # few values, so there are ties
+                         'freq': rng.integers(0, 8, n).astype(float),
+                         'image': rng.random(n),
+                         'wordclass': rng.choice(['noun', 'verb', 'adj'], n),
+                         'single': 'a'})
+
+
+def bad_split(data, no_sets):
+    # deal every instance by its sorted frequency, so that the sets differ in freq and usually fail
+    set_numbers = np.zeros(len(data), dtype=np.int64)
+    for _, rows in data.groupby('stratum').indices.items():
+        order = rows[np.argsort(data['freq'].to_numpy()[rows], kind='stable')]
+        set_numbers[order] = np.arange(len(order)) * no_sets // len(order) + 1
+    return set_numbers
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_running_statistics_match_recomputation(seed):
+    rng = np.random.default_rng(seed)
+    data = make_data(rng)
+    no_sets = 2 + seed % 3
+    groups = model.test_groups(data, CONTINUOUS, CATEGORICAL, ['stratum'])
+    start = bad_split(data, no_sets)
+
+    optimizer = model.SwapOptimizer(groups, start, no_sets)
+    set_numbers = optimizer.run(200, np.random.RandomState(seed))
+    assert (set_numbers != start).any()
+
+    fresh = model.SwapOptimizer(groups, set_numbers, no_sets)
+    for g in range(len(groups)):
+        np.testing.assert_array_equal(optimizer.rank_sums[g], fresh.rank_sums[g])
+        np.testing.assert_array_equal(optimizer.tables[g], fresh.tables[g])
+        np.testing.assert_allclose(optimizer.kw_stats[g], fresh.kw_stats[g], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(optimizer.chi_stats[g], fresh.chi_stats[g], rtol=1e-9, atol=1e-9)
+    assert optimizer.score() == pytest.approx(fresh.score(), abs=1e-9)
+
+    # and the running statistics are the ones statistics() reports
+    stats = model.statistics(groups, set_numbers, CONTINUOUS, CATEGORICAL)
+    for g in range(len(groups)):
+        # statistics() gives a list of Kruskal-Wallis tests, then one of chi-square tests, per group
+        kw_tests, chi_tests = stats[2 * g], stats[2 * g + 1]
+        np.testing.assert_allclose(optimizer.kw_stats[g], [test[3] for test in kw_tests], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(optimizer.chi_stats[g], [test[3] for test in chi_tests], rtol=1e-9, atol=1e-9)
@@ -0,0 +1,14 @@
+import numpy as np
+import pandas as pd
+
+import model
+
+
+def test_large_numeric_categories_stay_apart_in_low_memory_mode():
+    # 2^24 and 2^24 + 1 are the same number in float32, their codes are not
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'id': 16777216 + rng.integers(0, 2, 100), 'x': rng.random(100)})
+    for low_memory in (False, True):
+        splitter = model.Splitter(data, ['c', 'n'], 2, low_memory=low_memory)
+        categorical = splitter.prepared.matrix[:, splitter.prepared.categorical_idx[0]]
+        assert len(np.unique(categorical)) == 2
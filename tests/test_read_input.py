@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+import model
+
+TYPES = {'cond': 'a', 'freq': 'n', 'cat': 'c', 'code': 'c'}
+
+
+def write_input(path):
+    # 'cond' holds text in the first half of the rows and only digits in the second half
+    rng = np.random.default_rng(0)
+    pd.DataFrame({'item': ['item%d' % i for i in range(60)],
+                  'cond': ['a', 'b', 'c'] * 10 + ['1', '2', '3'] * 10,
+                  'freq': rng.random(60).round(2),
+                  'cat': rng.choice(['x', 'y'], 60),
+                  'code': rng.integers(0, 3, 60)}).to_csv(path, index=False)
+
+
+def test_chunks_with_different_guessed_types(tmp_path):
+    path = tmp_path / 'mixed.csv'
+    write_input(path)
+    whole = model.read_input(path, list(TYPES), TYPES)
+    for chunksize in (30, 7):
+        chunked = model.read_input(path, list(TYPES), TYPES, chunksize)
+        pd.testing.assert_frame_equal(chunked, whole)
+
+
+def test_chunked_split_matches_whole_file(tmp_path):
+    path = tmp_path / 'mixed.csv'
+    write_input(path)
+    columns = list(TYPES.values())
+    whole = model.Splitter(model.read_input(path, list(TYPES), TYPES), columns, 3).run(1)
+    chunked = model.Splitter(model.read_input(path, list(TYPES), TYPES, 30), columns, 3).run(1)
+    pd.testing.assert_series_equal(chunked.set_numbers, whole.set_numbers)
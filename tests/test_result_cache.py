@@ -0,0 +1,72 @@
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import model
+
+INPUT = pathlib.Path(__file__).resolve().parent.parent / 'test-files' / 'input.csv'
+TYPES = {'correct': 'a', 'freq': 'n', 'wordclass': 'c', 'image': 'n', 'testCat': 'c'}
+
+
+@pytest.fixture(scope='module')
+def splitter():
+    return model.Splitter(pd.read_csv(INPUT)[list(TYPES)], list(TYPES.values()), 3)
+
+
+@pytest.fixture(scope='module')
+def result(splitter):
+    result = splitter.run(1)
+    # a test without a result, as for a feature with the same value everywhere
+    result.stats[0][0][3:6] = [np.nan, 2, np.nan]
+    return result
+
+
+def test_round_trip(tmp_path, splitter, result):
+    cache = model.ResultCache(tmp_path, 'input')
+    assert cache.get(splitter, 1) is None
+    assert isinstance(result.stats[0][0][0], int)
+    cache.put(splitter, 1, result)
+    cached = cache.get(splitter, 1)
+
+    pd.testing.assert_series_equal(cached.set_numbers, result.set_numbers)
+    assert (cached.iteration, cached.significant) == (result.iteration, result.significant)
+    assert len(cached.stats) == len(result.stats)
+    for cached_group, group in zip(cached.stats, result.stats):
+        # the names of the absolute variable instances are numbers here, the last groups are "overall"
+        assert [test[:3] for test in cached_group] == [test[:3] for test in group]
+        assert [type(test[0]) for test in cached_group] == [type(test[0]) for test in group]
+        np.testing.assert_array_equal(np.array([test[3:6] for test in cached_group], dtype=np.float64),
+                                      np.array([test[3:6] for test in group], dtype=np.float64))
+
+
+def test_settings_change_the_key(tmp_path, splitter, monkeypatch):
+    cache = model.ResultCache(tmp_path, 'input')
+    paths = {cache.path(splitter, 1), cache.path(splitter, 2), cache.path(splitter, 1, reuse_sweep=True),
+             model.ResultCache(tmp_path, 'other input').path(splitter, 1)}
+    for setting, value in [('no_sets', 4), ('max_attempts', 5), ('swaps', 100), ('sample_size', 20),
+                           ('k_select', 'elbow'), ('assignment', 'greedy'), ('warm_start', True),
+                           ('low_memory', True), ('min_cluster_rows', 20)]:
+        with monkeypatch.context() as patch:
+            patch.setattr(splitter, setting, value)
+            paths.add(cache.path(splitter, 1))
+    assert len(paths) == 13
+    assert cache.path(splitter, 1) in paths
+
+
+def test_least_recently_used_results_are_removed(tmp_path, splitter, result):
+    cache = model.ResultCache(tmp_path, 'input')
+    paths = []
+    for seed in (1, 2, 3):
+        cache.put(splitter, seed, result)
+        paths.append(cache.path(splitter, seed))
+    for age, path in zip((1000, 2000, 3000), paths):
+        os.utime(path, (age, age))
+    # using the oldest result makes it the most recent one
+    assert cache.get(splitter, 1) is not None
+
+    cache.max_bytes = sum(path.stat().st_size for path in paths) - 1
+    cache.evict()
+    assert [path.exists() for path in paths] == [True, False, True]
@@ -0,0 +1,31 @@
+import pathlib
+
+import pandas as pd
+import pytest
+
+import batch
+import model
+import service
+
+INPUT = pathlib.Path(__file__).resolve().parent.parent / 'test-files' / 'input.csv'
+
+
+@pytest.fixture
+def split_service(monkeypatch):
+    # serve() loads these modules, the tests use the service without a server
+    monkeypatch.setattr(service, 'model', model)
+    monkeypatch.setattr(service, 'batch', batch)
+    monkeypatch.setattr(service, 'pd', pd)
+    return service.SplitService()
+
+
+def split_request(**fields):
+    return dict(csv=INPUT.read_text(encoding='utf-8-sig'), columns='l a n c n c', sets=3, **fields)
+
+
+@pytest.mark.parametrize('request_body', [[1, 2], 'split', split_request(k_select='bogus'),
+                                          split_request(assign='random'), split_request(colour='red')])
+def test_bad_requests_are_value_errors(split_service, request_body):
+    # do_POST answers these with 400
+    with pytest.raises(ValueError):
+        next(split_service.split(request_body))
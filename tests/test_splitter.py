@@ -0,0 +1,49 @@
+import argparse
+import pathlib
+
+import pandas as pd
+import pytest
+
+import model
+
+INPUT = pathlib.Path(__file__).resolve().parent.parent / 'test-files' / 'input.csv'
+COLUMNS = ['l', 'a', 'n', 'c', 'n', 'c']
+
+
+@pytest.fixture(scope='module')
+def data():
+    return pd.read_csv(INPUT)
+
+
+@pytest.mark.parametrize('settings', [dict(max_attempts=0), dict(sample_size=0), dict(sample_size=-5)])
+def test_invalid_settings_are_value_errors(data, settings):
+    with pytest.raises(ValueError):
+        model.Splitter(data, COLUMNS, 3, **settings)
+
+
+@pytest.mark.parametrize('column', ['wordclass', 'freq'])
+def test_missing_feature_values_are_value_errors(data, column):
+    data = data.astype({column: object})
+    data.loc[3, column] = None
+    with pytest.raises(ValueError, match=column):
+        model.Splitter(data, COLUMNS, 3)
+
+
+@pytest.mark.parametrize('option', ['--attempts', '--runs', '--sample-size'])
+@pytest.mark.parametrize('value', ['0', '-1', 'x'])
+def test_options_that_need_a_positive_number(option, value):
+    with pytest.raises(SystemExit):
+        model.parse_arguments([str(INPUT), '3', option, value])
+    assert getattr(model.parse_arguments([str(INPUT), '3', option, '2']), option[2:].replace('-', '_')) == 2
+
+
+def test_sweeps_are_not_shared_between_different_settings(data, monkeypatch):
+    monkeypatch.setattr(model, 'sweep_cache', {})
+    model.Splitter(data, COLUMNS, 3).prepare_sweeps()
+    cold = dict(model.sweep_cache)
+    splitter = model.Splitter(data, COLUMNS, 3, keep_models=True, warm_start=True)
+    splitter.prepare_sweeps()
+    assert len(model.sweep_cache) == 2 * len(cold)
+    for stratum in splitter.prepared.strata:
+        sweep = model.sweep_cache[model.sweep_cache_key(stratum.key, None, 1000, 'silhouette', True, True)]
+        assert sweep.models
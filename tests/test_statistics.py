@@ -0,0 +1,66 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import chi2_contingency, kruskal
+
+import model
+
+CONTINUOUS = ['freq', 'image', 'constant']
+CATEGORICAL = ['wordclass', 'single']
+
+
+def make_data(rng, n=60):
+    return pd.DataFrame({'stratum': rng.choice(['x', 'y', 'z'], n),
+                         # few values, so there are ties
+                         'freq': rng.integers(0, 8, n).astype(float),
+                         'image': rng.random(n),
+                         'constant': 1.0,
+                         'wordclass': rng.choice(['noun', 'verb', 'adj'], n),
+                         # a single category, so its tables have no degrees of freedom
+                         'single': 'a'})
+
+
+def scipy_statistics(data, set_numbers):
+    # the tests of every absolute variable instance (in order of appearance), then overall, with scipy
+    present = np.unique(set_numbers)
+    groups = [data.index[data['stratum'] == name] for name in pd.unique(data['stratum'])] + [data.index]
+    tests = []
+    for rows in groups:
+        sets = set_numbers[rows]
+        for feat in CONTINUOUS:
+            samples = [data.loc[rows, feat].to_numpy()[sets == s] for s in present]
+            if any(len(sample) == 0 for sample in samples) or np.ptp(np.concatenate(samples)) == 0:
+                # a set that is empty in this instance, or the same value everywhere: no result
+                # (scipy's rounding can turn the latter into inf instead of nan)
+                tests.append((np.nan, len(present) - 1, np.nan))
+                continue
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                h, p = kruskal(*samples)
+            tests.append((h, len(present) - 1, p))
+        for feat in CATEGORICAL:
+            stat, p, dof, _ = chi2_contingency(pd.crosstab(data.loc[rows, feat].to_numpy(), sets))
+            tests.append((stat, dof, p))
+    return np.array(tests, dtype=np.float64)
+
+
+def model_statistics(data, set_numbers):
+    groups = model.test_groups(data, CONTINUOUS, CATEGORICAL, ['stratum'])
+    stats = model.statistics(groups, set_numbers, CONTINUOUS, CATEGORICAL)
+    return np.array([test[3:6] for testgroup in stats for test in testgroup], dtype=np.float64)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_statistics_match_scipy(seed):
+    rng = np.random.default_rng(seed)
+    data = make_data(rng)
+    no_sets = 2 + seed % 3
+    set_numbers = rng.integers(1, no_sets + 1, len(data))
+    if seed % 2:
+        # leave the last set empty in one instance
+        in_x = (data['stratum'] == 'x').to_numpy()
+        set_numbers[in_x] = rng.integers(1, no_sets, in_x.sum())
+    np.testing.assert_allclose(model_statistics(data, set_numbers), scipy_statistics(data, set_numbers),
+                               rtol=1e-10, atol=1e-12, equal_nan=True)
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import model
+
+DATA = pd.DataFrame({'x': ['b', 'a', None, 'b', 'a'], 'y': [2, 1, 1, 2, np.nan], 'same': 'z'})
+
+
+@pytest.mark.parametrize('sort', [False, True])
+def test_one_absolute_column(sort):
+    codes, names = model.absolute_codes(DATA, ['x'], sort)
+    expected = ['a', 'b', np.nan] if sort else ['b', 'a', np.nan]
+    assert list(names[:2]) == expected[:2] and pd.isna(names[2])
+    # the missing value is an instance of its own
+    np.testing.assert_array_equal(codes, [1, 0, 2, 1, 0] if sort else [0, 1, 2, 0, 1])
+
+
+def test_several_absolute_columns_in_order_of_appearance():
+    codes, names = model.absolute_codes(DATA, ['x', 'y'])
+    np.testing.assert_array_equal(codes, [0, 1, 2, 0, 3])
+    assert names == ['b / 2.0', 'a / 1.0', 'nan / 1.0', 'a / nan']
+
+
+def test_several_absolute_columns_sorted():
+    # by the first column, then the next, missing values last
+    codes, names = model.absolute_codes(DATA, ['x', 'y'], sort=True)
+    np.testing.assert_array_equal(codes, [2, 0, 3, 2, 1])
+    assert names == ['a / 1.0', 'a / nan', 'b / 2.0', 'nan / 1.0']
+
+
+@pytest.mark.parametrize('sort', [False, True])
+def test_a_constant_column_does_not_change_the_instances(sort):
+    one, _ = model.absolute_codes(DATA, ['x'], sort)
+    several, names = model.absolute_codes(DATA, ['x', 'same'], sort)
+    np.testing.assert_array_equal(one, several)
+    assert names[0] == ('a / z' if sort else 'b / z')
+
+
+def test_small_instances_are_not_clustered():
+    rng = np.random.default_rng(0)
+    sizes = [5, 10, 12, 40]
+    data = pd.DataFrame({'s': np.repeat(np.arange(len(sizes)), sizes), 'f': rng.random(sum(sizes)),
+                         'c': rng.choice(['p', 'q'], sum(sizes))})
+    # at least min_cluster_rows (10) and four rows per set
+    splitter = model.Splitter(data, ['a', 'n', 'c'], 3)
+    assert [splitter.clustered(stratum) for stratum in splitter.prepared.strata] == [False, False, True, True]
+    result = splitter.run(1)
+    # every instance is divided as evenly as possible
+    for size, counts in zip(sizes, pd.crosstab(data['s'], result.set_numbers).to_numpy()):
+        assert counts.max() - counts.min() <= 1 and counts.sum() == size